@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Aho-Corasick automaton to find many strings in a text in one pass. Used by replace_lines.py (substring and token replacement) and partial_match1.py."""
+
+from collections import deque
+
+def is_word_character(c):
+    """ Check if a character is part of a token (the same characters as \\w in regular expressions)."""
+    return c.isalnum() or c == '_'
+
+class AhoCorasick:
+    """ Aho-Corasick automaton built from a collection of patterns. Empty patterns are ignored."""
+
+    def __init__(self, patterns):
+        # state 0 is the root; each state has its transitions, failure link
+        # and the lengths of the patterns ending there (longest first, including
+        # the patterns of the states on its failure chain)
+        self.goto = [{}]
+        self.fail = [0]
+        self.lengths = [()]
+        for pattern in patterns:
+            self.add(pattern)
+        self.build()
+
+    def add(self, pattern):
+        """ Add a pattern to the trie."""
+        if not pattern:
+            return
+        state = 0
+        for c in pattern:
+            next_state = self.goto[state].get(c)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][c] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.lengths.append(())
+            state = next_state
+        self.lengths[state] = (len(pattern),)
+
+    def build(self):
+        """ Compute the failure links breadth first and merge the pattern lengths along them."""
+        goto, fail, lengths = self.goto, self.fail, self.lengths
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in goto[state].items():
+                queue.append(next_state)
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(c, 0)
+                fail[next_state] = f
+                lengths[next_state] = lengths[next_state] + lengths[fail[next_state]]
+
+    def __len__(self):
+        return len(self.goto)
+
+    def iter_matches(self, text):
+        """ Yield (start, end) for every occurrence of every pattern in a text, in order of the end position (overlapping occurrences included)."""
+        goto, fail, lengths = self.goto, self.fail, self.lengths
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if lengths[state]:
+                end = i + 1
+                for length in lengths[state]:
+                    yield (end - length, end)
+
+    def found(self, text):
+        """ Get the set of patterns that occur in a text."""
+        goto, fail, lengths = self.goto, self.fail, self.lengths
+        patterns = set()
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if lengths[state]:
+                end = i + 1
+                for length in lengths[state]:
+                    patterns.add(text[end - length:end])
+        return patterns
+
+    def replace(self, text, replacement, tokens=False):
+        """ Replace the occurrences of the patterns in a text with replacement(pattern). Overlaps are resolved leftmost-longest first.
+        With tokens=True only whole tokens are replaced, i.e. occurrences not preceded or followed by a word character."""
+        best = {} # start -> end of the longest occurrence starting there
+        for start, end in self.iter_matches(text):
+            if tokens and ((start > 0 and is_word_character(text[start - 1])) or (end < len(text) and is_word_character(text[end]))):
+                continue
+            if end > best.get(start, start):
+                best[start] = end
+        if not best:
+            return text
+        parts = []
+        position = 0
+        for start in sorted(best):
+            if start < position:
+                continue # overlaps the previous replacement
+            end = best[start]
+            parts.append(text[position:start])
+            parts.append(replacement(text[start:end]))
+            position = end
+        parts.append(text[position:])
+        return ''.join(parts)
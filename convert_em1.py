@@ -10,14 +10,26 @@ __version__ = "2022-05-04"
 # Import command-line parsing module from the Python standard library.
 ######################################################################
 import argparse
+# Compiled, memory-mapped dictionaries (see dictionary_index.py)
+from dictionary_index import DictionaryIndex, is_index, read_dictionary, map_chunks, read_chunk
+# Standard library modules for buffered streaming and benchmarking
+import sys
+import os
+import time
+import io
+from itertools import islice
 
 ### Mandatory positional arguments
 parser = argparse.ArgumentParser( description='Look up items from a dictionary, convert them, and print the results to standard output.' )
-parser.add_argument( 'your_dictionary', help='Path to your dictionary file. FORMAT: Use two columns separated by tab (default) or comma (optional).' )
-parser.add_argument( 'your_list', help='Path to your file with the list of items to convert using the dictionary. FORMAT: one item per line.' )
+parser.add_argument( 'your_dictionary', help='Path to your dictionary file. FORMAT: Use two columns separated by tab (default) or comma (optional), or an index file compiled with dictionary_index.py.' )
+parser.add_argument( 'your_list', help='Path to your file with the list of items to convert using the dictionary. FORMAT: one item per line. Use - to read from standard input.' )
 
 ### Optional arguments:
 parser.add_argument('-e', '--error_message', help='Specify an error message if a key is not in your specified dictionary table.', nargs='?', default='verbose', const='verbose' ) # if not specified by user then it defaults to given value
+parser.add_argument('-a', '--all_values', help='Print all the values of keys that occur more than once in the dictionary (instead of the first value only),\nseparated by the --value_separator.', action='store_true')
+parser.add_argument('-s', '--value_separator', help='Separator between multiple values with --all_values (default: |).', default='|')
+parser.add_argument('-w', '--workers', help='Number of worker processes converting chunks of a large list file in parallel (default: 1).', type=int, default=1)
+parser.add_argument('-b', '--benchmark', help='Compare the throughput of line-by-line printing with the buffered conversion on your list (no output) and exit.', action='store_true')
 
 ### Optional, but mutually exclusive user options:
 group = parser.add_mutually_exclusive_group()
@@ -26,6 +38,10 @@ group.add_argument('-t', '--tab', help='Use tab as column separator.', action='s
 
 
 args = parser.parse_args()
+if args.workers < 1:
+    parser.error('--workers must be at least 1')
+if args.workers > 1 and args.your_list == '-':
+    parser.error('--workers needs a list file, not standard input')
 
 ######################################################################
 # The dictionary to use must be provided by the user.
@@ -40,30 +56,28 @@ else:
 # input filename
 fname = args.your_dictionary
 
-
-try:
-    fhand = open( fname )
-except:
-    print('File cannot be opened:', fname)
-    exit()
-
-# Make an empty dictionary:
-d = dict()
-
-for line in fhand:
-    line = line.rstrip()
-    columns = line.split(delimiter)
+if is_index(fname):
+    # a dictionary compiled with dictionary_index.py
+    d = DictionaryIndex(fname)
+else:
     try:
-        k = columns[0]
-        v = columns[1]
+        fhand = open( fname )
     except:
-        v = 'Check your dictionary file format.'
-        print( 'ERROR:', v)
+        print('File cannot be opened:', fname)
         exit()
-    if k not in d:
-        d[k] = v
-# close file
-fhand.close()
+
+    # Make an empty dictionary:
+    d = dict()
+    # further values of keys that occur more than once (with --all_values)
+    more_values = dict()
+
+    for k, v in read_dictionary(fhand, delimiter):
+        if k not in d:
+            d[k] = v
+        elif args.all_values:
+            more_values.setdefault(k, []).append(v)
+    # close file
+    fhand.close()
 
 #################################################################
 # Read in and convert data file.
@@ -71,20 +85,93 @@ fhand.close()
 
 fname = args.your_list
 
-try:
-    fhand = open( fname )
-except:
-    print('File cannot be opened:', fname)
-    exit()
+if args.error_message == 'verbose':
+    error_format = 'ERROR: {} is not in your dictionary!!'
+else:
+    error_format = args.error_message.replace('{', '{{').replace('}', '}}')
+
+def convert_lines(lines):
+    """ Convert a batch of lines and return the output text."""
+    get = d.get
+    output = []
+    append = output.append
+    for line in lines:
+        words = line.rstrip()
+        value = get(words)
+        if value is None:
+            append(error_format.format(words))
+        elif args.all_values:
+            if isinstance(d, DictionaryIndex):
+                append(args.value_separator.join(d.get_all(words)))
+            elif words in more_values:
+                append(args.value_separator.join([value] + more_values[words]))
+            else:
+                append(value)
+        else:
+            append(value)
+    output.append('')
+    return '\n'.join(output)
+
+def convert_stream(fhand, out, batch_size=65536):
+    """ Convert an input stream in batches of lines with buffered writes."""
+    while True:
+        lines = list(islice(fhand, batch_size))
+        if not lines:
+            break
+        out.write(convert_lines(lines))
+
+def convert_line_by_line(fhand, out):
+    """ The previous conversion loop: print() every line and catch the misses."""
+    for line in fhand:
+        words = line.rstrip()
+        try:
+            print(d[words], file=out)
+        except:
+            if args.error_message == 'verbose':
+                print( 'ERROR:', words ,'is not in your dictionary!!', file=out)
+            else:
+                print(args.error_message, file=out)
+
+if args.benchmark:
+    if fname == '-' or isinstance(d, DictionaryIndex) or args.all_values:
+        parser.error('--benchmark needs a list file and a plain dictionary without --all_values')
+    with open(os.devnull, 'w') as out:
+        for name, convert in (('line by line', convert_line_by_line), ('buffered', convert_stream)):
+            with open(fname) as fhand:
+                start = time.perf_counter()
+                convert(fhand, out)
+                seconds = time.perf_counter() - start
+            with open(fname) as fhand:
+                n = sum(1 for line in fhand)
+            print(f'{name}:\t{n / seconds:,.0f} lines per second', file=sys.stderr)
+    sys.exit()
+
+def convert_chunk(chunk):
+    """ Convert a (start, end, is_last) byte range of the list file in a worker process."""
+    start, end, is_last = chunk
+    return convert_lines(io.StringIO(read_chunk(fname, start, end)))
+
+if args.workers > 1:
+    try:
+        open( fname ).close()
+    except:
+        print('File cannot be opened:', fname)
+        exit()
+    for output in map_chunks(convert_chunk, fname, args.workers):
+        sys.stdout.write(output)
+    sys.exit()
 
-for line in fhand:
-    words = line.rstrip()
+if fname == '-':
+    fhand = sys.stdin
+else:
     try:
-        print(d[words])
+        fhand = open( fname )
     except:
-        if args.error_message == 'verbose':
-            print( 'ERROR:', words ,'is not in your dictionary!!')
-        else:
-            print(args.error_message)
+        print('File cannot be opened:', fname)
+        exit()
+
+convert_stream(fhand, sys.stdout)
+
 # close file
-fhand.close()
+if fhand is not sys.stdin:
+    fhand.close()
@@ -17,15 +17,42 @@ import argparse
 import requests
 import sys
 #################################################################
+# Standard library modules for concurrent requests and rate limiting
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+# Standard library modules for streaming input/output
+import queue
+from collections import OrderedDict
+# Standard library modules for the offline chain file index
+import bisect
+import heapq
+import gzip
+from array import array
+# Standard library modules for the persistent liftover cache
+import json
+import sqlite3
+#################################################################
 
 # input filename
 fname = 'filename?'
 
 parser = argparse.ArgumentParser( description='Convert genomic coordinates from GRCh38 to GRCh37 (default) or vice versa. All genomic coordinates are assumed to be on the positive strand. Input file is expected to be in a tabulated format (tsv/csv), e.g. :\n\t#chromosome   start   end\n\t17 36169091    36169091\n\tX 3084378 3084378', formatter_class=argparse.RawTextHelpFormatter )
-parser.add_argument( 'input_file', help='Path to your input file.' )
+parser.add_argument( 'input_file', help='Path to your input file. Use - to read from standard input.' )
 
 # User options:
 parser.add_argument('-v', '--verbose', help='Choose verbose output.', action='store_true')
+parser.add_argument('-w', '--workers', help='Number of concurrent requests to the Ensembl REST API (default: 4).', type=int, default=4)
+parser.add_argument('-b', '--buffer', help='Maximum number of rows waiting to be printed in input order (default: 1000).', type=int, default=1000)
+parser.add_argument('--chain', help='Convert offline with a local UCSC/Ensembl chain file (plain or gzipped) instead of the REST API,\ne.g. GRCh38_to_GRCh37.chain.gz. It must match the chosen direction of conversion.', default=None)
+parser.add_argument('--cache', help='Path to a persistent SQLite cache of REST API results (created if missing).', default=None)
+parser.add_argument('--cache_ttl', help='Ignore cached results older than this many days (default: no expiry).', type=float, default=None)
+parser.add_argument('--cache_version', help='Version stamp for cached results (default: the current Ensembl release reported by the server).\nCached results with a different stamp are ignored and refreshed.', default=None)
+parser.add_argument('--cache_only', help='Use cached results only and never contact the server. Loci missing from the cache are reported as failed.', action='store_true')
+parser.add_argument('--cache_stats', help='Print cache hit-rate statistics to standard error.', action='store_true')
+parser.add_argument('--journal', help='Path to a checkpoint journal (JSON lines) of the query regions converted via the REST API.', default=None)
+parser.add_argument('--resume', help='Reuse the results in the --journal of an interrupted run and convert only the remaining query regions.', action='store_true')
+parser.add_argument('--server', help='Ensembl REST API base URL (default: https://rest.ensembl.org). Point it at a local mirror or stub server for testing.', default='https://rest.ensembl.org')
 
 # Optional, but mutually exclusive user options:
 ## genome build options
@@ -41,6 +68,73 @@ args = parser.parse_args()
 # input filename
 fname = args.input_file
 
+if args.workers < 1:
+    parser.error('--workers must be at least 1')
+if args.buffer < 1:
+    parser.error('--buffer must be at least 1')
+if ( args.cache_only or args.cache_stats or args.cache_ttl or args.cache_version ) and not args.cache:
+    parser.error('the --cache_* options require --cache')
+if args.resume and not args.journal:
+    parser.error('--resume requires --journal')
+
+#################################################################
+# Shared HTTP session and rate limiting
+#################################################################
+# https://github.com/Ensembl/ensembl-rest/wiki/Rate-Limits
+## Every response carries X-RateLimit-Remaining/X-RateLimit-Reset headers,
+## and a 429 response carries a Retry-After header (in seconds).
+server = args.server.rstrip('/')
+maxRetries = 5
+
+# Keep-alive connections are pooled and reused by all worker threads.
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.workers)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+session.headers.update({ "Content-Type" : "application/json" })
+
+# All workers pause until this (monotonic) time once the server asks us to slow down.
+throttleLock = threading.Lock()
+resumeAt = 0.0
+
+def backOff( seconds ):
+    """ Make every worker wait at least the given number of seconds before its next request."""
+    global resumeAt
+    with throttleLock:
+        resumeAt = max( resumeAt, time.monotonic() + seconds )
+
+def waitForServer():
+    """ Sleep until the shared back-off period (if any) is over."""
+    with throttleLock:
+        delay = resumeAt - time.monotonic()
+    if delay > 0:
+        time.sleep( delay )
+
+def ensemblGet( url ):
+    """ Send a GET request to the Ensembl REST API. Honour the rate-limit headers and retry on 429 and 5xx responses or network errors with exponential back-off."""
+    for attempt in range( maxRetries + 1 ):
+        waitForServer()
+        try:
+            r = session.get( url, timeout=60 )
+        except ( requests.exceptions.ConnectionError, requests.exceptions.Timeout ):
+            if attempt == maxRetries:
+                raise
+            backOff( 2 ** attempt )
+            continue
+        if r.status_code == 429 or r.status_code >= 500:
+            if attempt == maxRetries:
+                break
+            retryAfter = r.headers.get('Retry-After')
+            backOff( float(retryAfter) if retryAfter else 2 ** attempt )
+            continue
+        # slow down before the allowance runs out rather than after
+        remaining = r.headers.get('X-RateLimit-Remaining')
+        if remaining is not None and int(remaining) <= args.workers:
+            reset = r.headers.get('X-RateLimit-Reset')
+            backOff( float(reset) if reset else 1 )
+        break
+    return(r)
+
 ##########################################################################
 # define coordinate converter function
 #################################################################
@@ -51,54 +145,12 @@ fname = args.input_file
 def convertCoordinates( asmDirection, query_region ):
     """ Convert a set of genomic coordinates."""
 
-    #################################################################
-    #default values in case ENSEMBL api failed to map coordinates between genome assemblies:
-    dfv = {
-    'original': {
-                    'seq_region_name': 'failed',
-                    'start': 'failed',
-                    'coord_system': 'chromosome',
-                    'strand': 1,
-                    'assembly': asm[0],
-                    'end': 'failed'
-                },
-    'mapped': {
-                    'seq_region_name': 'failed',
-                    'start': 'failed',
-                    'coord_system': 'chromosome',
-                    'strand': 'failed',
-                    'assembly': asm[1],
-                    'end': 'failed'
-              }
-    }
-    #default values in case ENSEMBL api finds multiple possible mapping coordinates between genome assemblies:
-    dfv2 = {
-    'original': {
-                    'seq_region_name': 'multiple',
-                    'start': 'multiple',
-                    'coord_system': 'chromosome',
-                    'strand': 1,
-                    'assembly': asm[0],
-                    'end': 'multiple'
-                },
-    'mapped': {
-                    'seq_region_name': 'multiple',
-                    'start': 'multiple',
-                    'coord_system': 'chromosome',
-                    'strand': 'multiple',
-                    'assembly': asm[1],
-                    'end': 'multiple'
-              }
-    }
-    #################################################################
-
-    server = 'https://rest.ensembl.org'
     ext1 = '/map/human/'
     asm_one = asmDirection[0]
     queryRegion = '/' + query_region[0] + ':' + query_region[1] + '..' + query_region[2] + ':1/'  # seq_region_name + start + stop
     asm_two = asmDirection[1] + '?'
      
-    r = requests.get(server+ext1+asm_one+queryRegion+asm_two, headers={ "Content-Type" : "application/json"})
+    r = ensemblGet(server+ext1+asm_one+queryRegion+asm_two)
      
     if not r.ok:
       error1 = r.raise_for_status()
@@ -137,6 +189,199 @@ def convertCoordinates( asmDirection, query_region ):
 #### }
 ##########################################################################
 
+##########################################################################
+# define persistent cache functions
+#################################################################
+# Results are keyed by (asm_from, asm_to, chrom, start, end) and stamped
+# with the Ensembl release and the time they were fetched.
+#################################################################
+##########################################################################
+def ensemblRelease():
+    """ Get the current Ensembl release from the REST API to use as the cache version stamp."""
+    r = ensemblGet(server+'/info/data/?')
+    if not r.ok:
+        r.raise_for_status()
+    return( str( max( r.json()['releases'] ) ) )
+
+def openCache( cacheFile ):
+    """ Open (or create) the SQLite liftover cache."""
+    db = sqlite3.connect( cacheFile )
+    db.execute('''CREATE TABLE IF NOT EXISTS mappings (
+                    asm_from TEXT, asm_to TEXT, chrom TEXT, start TEXT, end TEXT,
+                    version TEXT, fetched REAL, mapping TEXT,
+                    PRIMARY KEY (asm_from, asm_to, chrom, start, end) )''')
+    return(db)
+
+def cacheLookup( db, asmDirection, query_region, version, ttl ):
+    """ Return the cached mapping of a query region, or None if it is missing, stale or from another version."""
+    row = db.execute( 'SELECT version, fetched, mapping FROM mappings WHERE asm_from=? AND asm_to=? AND chrom=? AND start=? AND end=?', asmDirection + tuple(query_region) ).fetchone()
+    if row is None:
+        return(None)
+    if version is not None and row[0] != version:
+        return(None)
+    if ttl is not None and time.time() - row[1] > ttl * 86400:
+        return(None)
+    return( json.loads( row[2] ) )
+
+def cacheStore( db, asmDirection, results, version ):
+    """ Save a dictionary of query region -> mapping results in the cache."""
+    now = time.time()
+    with db: # a single transaction
+        db.executemany( 'INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ( asmDirection + tuple(q) + ( version, now, json.dumps(m) ) for q, m in results.items() ) )
+
+##########################################################################
+# define checkpoint journal functions
+#################################################################
+# One JSON object per line: {"asm": [...], "locus": [...], "mappings": {...}}
+#################################################################
+##########################################################################
+def readJournal( journalFile, asmDirection ):
+    """ Read the converted query regions from a checkpoint journal. Returns a dictionary of query region -> mapping."""
+    done = {}
+    try:
+        jhand = open( journalFile )
+    except FileNotFoundError:
+        return(done)
+    with jhand:
+        for line in jhand:
+            try:
+                entry = json.loads( line )
+            except ValueError: # the last line of an interrupted run may be incomplete
+                continue
+            if tuple( entry['asm'] ) == asmDirection:
+                done[ tuple( entry['locus'] ) ] = entry['mappings']
+    return(done)
+
+def writeJournal( jhand, asmDirection, query_region, mappings ):
+    """ Append a converted query region to the checkpoint journal."""
+    jhand.write( json.dumps( { 'asm': asmDirection, 'locus': query_region, 'mappings': mappings } ) + '\n' )
+    jhand.flush()
+
+##########################################################################
+# define offline chain file converter functions
+#################################################################
+# https://genome.ucsc.edu/goldenPath/help/chain.html
+## chain score tName tSize tStrand tStart tEnd qName qSize qStrand qStart qEnd id
+## size dt dq
+## ...
+## size
+# Chain coordinates are zero-based, half-open.
+#################################################################
+##########################################################################
+def chromosomeName( name ):
+    """ Drop the UCSC 'chr' prefix so that UCSC and Ensembl style sequence region names match."""
+    if name.lower().startswith('chr'):
+        name = name[3:]
+    if name == 'M':
+        name = 'MT'
+    return(name)
+
+def readChainFile( chainFile ):
+    """ Build an interval index of the aligned blocks in a chain file. Returns a dictionary keyed by source chromosome of layers of non-overlapping blocks,
+    each sorted by start position in compact arrays. Within a layer the ends are sorted too, so the blocks overlapping a region are found with two binary searches per layer.
+    The number of layers is the largest number of blocks overlapping any position (usually 1 or 2), however long the blocks are."""
+    blocks = {}
+    opener = gzip.open if chainFile.endswith('.gz') else open
+    with opener( chainFile, 'rt' ) as chandle:
+        for line in chandle:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == 'chain':
+                tName = chromosomeName( fields[2] )
+                tPos = int( fields[5] )
+                qName = chromosomeName( fields[7] )
+                qSize = int( fields[8] )
+                qStrand = fields[9]
+                qPos = int( fields[10] )
+                continue
+            size = int( fields[0] )
+            if qStrand == '+':
+                blocks.setdefault( tName, [] ).append( ( tPos, tPos + size, qName, qPos, 1 ) )
+            else: # convert reverse strand query coordinates to the forward strand
+                blocks.setdefault( tName, [] ).append( ( tPos, tPos + size, qName, qSize - qPos - size, -1 ) )
+            if len( fields ) == 3: # gaps to the next block
+                tPos += size + int( fields[1] )
+                qPos += size + int( fields[2] )
+
+    index = {}
+    for chrom, chromBlocks in blocks.items():
+        chromBlocks.sort()
+        names = sorted( set( b[2] for b in chromBlocks ) )
+        nameIds = { n: i for i, n in enumerate(names) }
+        # put each block in the first layer that ends before it starts (interval partitioning)
+        layers = []
+        layerEnds = [] # heap of (end of the last block, layer number)
+        for b in chromBlocks:
+            if layerEnds and layerEnds[0][0] <= b[0]:
+                layer = heapq.heappop( layerEnds )[1]
+            else:
+                layer = len( layers )
+                layers.append( [] )
+            layers[layer].append( b )
+            heapq.heappush( layerEnds, ( b[1], layer ) )
+        index[chrom] = [ {
+            'starts': array( 'q', ( b[0] for b in layerBlocks ) ),
+            'ends': array( 'q', ( b[1] for b in layerBlocks ) ),
+            'names': names,
+            'nameIds': array( 'l', ( nameIds[b[2]] for b in layerBlocks ) ),
+            'qStarts': array( 'q', ( b[3] for b in layerBlocks ) ),
+            'strands': array( 'b', ( b[4] for b in layerBlocks ) )
+            } for layerBlocks in layers ]
+    return(index)
+
+def liftOver( asmDirection, query_region ):
+    """ Convert a set of genomic coordinates with the chain file index. Returns the same dictionary structure as convertCoordinates()."""
+    chrom = chromosomeName( query_region[0] )
+    if chrom not in chainIndex:
+        return(dfv)
+    try:
+        qStart = int( query_region[1] ) - 1 # zero-based, half-open
+        qEnd = int( query_region[2] )
+    except ValueError:
+        return(dfv)
+    # binary search for the blocks overlapping the query region in each layer:
+    # the first block ending after the query start up to the last block starting before the query end
+    hits = []
+    for c in chainIndex[chrom]:
+        first = bisect.bisect_right( c['ends'], qStart )
+        last = bisect.bisect_left( c['starts'], qEnd )
+        hits.extend( ( c, i ) for i in range( first, min( last, first + 2 ) ) ) # more than one hit is a failure anyway
+
+    if len( hits ) == 1: # check if query region maps to a single locus
+        c, i = hits[0]
+        start = max( qStart, c['starts'][i] )
+        end = min( qEnd, c['ends'][i] )
+        if c['strands'][i] == 1:
+            mappedStart = c['qStarts'][i] + start - c['starts'][i]
+        else:
+            mappedStart = c['qStarts'][i] + c['ends'][i] - end
+        mappings = {
+        'original': {
+                        'seq_region_name': query_region[0],
+                        'start': start + 1,
+                        'coord_system': 'chromosome',
+                        'strand': 1,
+                        'assembly': asmDirection[0],
+                        'end': end
+                    },
+        'mapped': {
+                        'seq_region_name': c['names'][ c['nameIds'][i] ],
+                        'start': mappedStart + 1,
+                        'coord_system': 'chromosome',
+                        'strand': c['strands'][i],
+                        'assembly': asmDirection[1],
+                        'end': mappedStart + end - start
+                  }
+        }
+    elif len( hits ) > 1: # check if query region maps to multiple sites
+        mappings = dfv2
+    else: # conversion has failed
+        mappings = dfv
+
+    return(mappings)
+
 #################################################################
 # Parse user input,
 # read in a data file and
@@ -162,55 +407,220 @@ if args.grch37:
 else:
     asm = tuple([asm_two, asm_one])
 
-# open input file
-try:
-    fhand1 = open( fname )
-except:
-    print('File cannot be opened:', fname)
-    exit()
-
-# initialise variable to hold input
-inputList = []
-locus = tuple()
-# Make an empty dictionary to hold unique query regions.
-## This is to reduce the number of queries to the server in case of redundant query data.
-loci = {}
-
-
-# read in file line-by-line
-for line in fhand1:
-    if line.startswith('#'): # skip header line
-        continue
-    line = line.strip()
-    columns = line.split(delimiter)
-    if len(columns) > 1: # check if line is not empty
-        locus = tuple(columns[:3])
-        inputList.append(locus)
-    else: # skip empty lines
-        continue
-    if locus in loci:
-        continue
+#################################################################
+#default values in case ENSEMBL api (or the chain file) failed to map coordinates between genome assemblies:
+dfv = {
+'original': {
+                'seq_region_name': 'failed',
+                'start': 'failed',
+                'coord_system': 'chromosome',
+                'strand': 1,
+                'assembly': asm[0],
+                'end': 'failed'
+            },
+'mapped': {
+                'seq_region_name': 'failed',
+                'start': 'failed',
+                'coord_system': 'chromosome',
+                'strand': 'failed',
+                'assembly': asm[1],
+                'end': 'failed'
+          }
+}
+#default values in case ENSEMBL api (or the chain file) finds multiple possible mapping coordinates between genome assemblies:
+dfv2 = {
+'original': {
+                'seq_region_name': 'multiple',
+                'start': 'multiple',
+                'coord_system': 'chromosome',
+                'strand': 1,
+                'assembly': asm[0],
+                'end': 'multiple'
+            },
+'mapped': {
+                'seq_region_name': 'multiple',
+                'start': 'multiple',
+                'coord_system': 'chromosome',
+                'strand': 'multiple',
+                'assembly': asm[1],
+                'end': 'multiple'
+          }
+}
+#################################################################
+
+# open input file ('-' reads from standard input)
+if fname == '-':
+    fhand1 = sys.stdin
+else:
+    try:
+        fhand1 = open( fname )
+    except:
+        print('File cannot be opened:', fname)
+        exit()
+
+# open the persistent cache and pick the version stamp of the cached results
+if args.cache and not args.chain:
+    cache = openCache( args.cache )
+    if args.cache_version:
+        cacheVersion = args.cache_version
+    elif args.cache_only:
+        cacheVersion = None # accept any cached version
     else:
-        loci[locus] = convertCoordinates( asm, locus )
-# close file
-fhand1.close()
+        cacheVersion = ensemblRelease()
+else:
+    cache = None
+cacheHits = 0
+cacheMisses = 0
+
+# checkpoint journal of an interrupted run
+if args.journal and not args.chain:
+    journalled = readJournal( args.journal, asm ) if args.resume else {}
+    journal = open( args.journal, 'a' if args.resume else 'w' )
+    if journal.tell() > 0: # make sure an incomplete last line is not continued
+        with open( args.journal, 'rb' ) as jhand:
+            jhand.seek( -1, 2 )
+            if jhand.read(1) != b'\n':
+                journal.write('\n')
+else:
+    journalled = {}
+    journal = None
+
+# Make a bounded dictionary to hold recently seen query regions.
+## This is to reduce the number of queries to the server in case of redundant query data,
+## while keeping memory use flat however long the input is.
+loci = OrderedDict()
+lociSize = 100000
+# The reorder buffer: converted (or pending) rows waiting to be printed in input order.
+## The reader blocks when it is full, which also bounds the number of requests in flight.
+rowQueue = queue.Queue( maxsize = args.buffer )
+endOfInput = None
+writerError = None
 
 #################################################################
 # Format and print results
 #################################################################
-# verbose output?
+def formatResult( locus, mappings ):
+    """ Format a converted query region as an output line."""
+    if args.verbose:
+        results = [ mappings['mapped']['assembly'], mappings['mapped']['seq_region_name'], mappings['mapped']['start'], mappings['mapped']['end'], mappings['mapped']['strand'] ]
+        inputCoordinates = list(locus)
+        return( ':'.join( str(c) for c in inputCoordinates) + '\t' + '\t'.join( str(r) for r in results) )
+    else:
+    #   results = [ mappings['mapped']['seq_region_name'], mappings['mapped']['start'], mappings['mapped']['end'], mappings['mapped']['assembly'], mappings['mapped']['strand'] ]
+        results = [ mappings['mapped']['seq_region_name'], mappings['mapped']['start'], mappings['mapped']['end'] ]
+        return( '\t'.join( str(r) for r in results) )
+
+def writeResults():
+    """ Print rows from the reorder buffer in input order as soon as they are converted, and save new REST results in the cache and journal."""
+    global writerError
+    if cache is not None:
+        # SQLite connections cannot be shared between threads
+        writerCache = openCache( args.cache )
+        newResults = {}
+    try:
+        while True:
+            row = rowQueue.get()
+            if row is endOfInput:
+                break
+            locus, result, isNew = row
+            if isinstance( result, Future ):
+                if not result.done():
+                    sys.stdout.flush() # do not hold back finished rows while waiting
+                mappings = result.result()
+            else:
+                mappings = result
+            print( formatResult( locus, mappings ) )
+            if journal is not None and isNew:
+                writeJournal( journal, asm, locus, mappings )
+            if cache is not None and isNew:
+                newResults[locus] = mappings
+                if len( newResults ) >= 1000:
+                    cacheStore( writerCache, asm, newResults, cacheVersion )
+                    newResults = {}
+        sys.stdout.flush()
+    except BaseException as error:
+        writerError = error
+        # keep draining the buffer so that the reader is never blocked
+        while rowQueue.get() is not endOfInput:
+            pass
+    finally:
+        if cache is not None:
+            if newResults:
+                cacheStore( writerCache, asm, newResults, cacheVersion )
+            writerCache.close()
+
+# print header line
 if args.verbose:
-    header = print( ' '.join(['#', asm[0], 'input coordinates']), 'Converted to assembly', 'seq_region_name', 'start', 'end', 'strand', sep='\t' )
-    for i in inputList:
-        results = [ loci[i]['mapped']['assembly'], loci[i]['mapped']['seq_region_name'], loci[i]['mapped']['start'], loci[i]['mapped']['end'], loci[i]['mapped']['strand'] ]
-        inputCoordinates = list(i)
-    #   print(i, loci[i] )
-    #   print( i, '\t'.join( str(r) for r in results), sep='\t')
-        print( ':'.join( str(c) for c in inputCoordinates), '\t'.join( str(r) for r in results), sep='\t')
-    #   print( loci[i] )
+    print( ' '.join(['#', asm[0], 'input coordinates']), 'Converted to assembly', 'seq_region_name', 'start', 'end', 'strand', sep='\t' )
 else:
-    header = print( ' '.join(['#', asm[1], 'seq_region_name']), 'start', 'end', sep='\t' )
-    for i in inputList:
-    #   results = [ loci[i]['mapped']['seq_region_name'], loci[i]['mapped']['start'], loci[i]['mapped']['end'], loci[i]['mapped']['assembly'], loci[i]['mapped']['strand'] ]
-        results = [ loci[i]['mapped']['seq_region_name'], loci[i]['mapped']['start'], loci[i]['mapped']['end'] ]
-        print( '\t'.join( str(r) for r in results), sep='\t')
+    print( ' '.join(['#', asm[1], 'seq_region_name']), 'start', 'end', sep='\t' )
+
+if args.chain:
+    chainIndex = readChainFile( args.chain )
+
+# Offline (--chain) and --cache_only results are ready at once: print them directly,
+## the reorder buffer and the writer thread are only needed for pending REST requests.
+synchronous = args.chain or args.cache_only
+if not synchronous:
+    writer = threading.Thread( target = writeResults )
+    writer.start()
+    pool = ThreadPoolExecutor( max_workers=args.workers )
+try:
+    # read in file line-by-line and convert the query regions offline or concurrently via the REST API
+    for line in fhand1:
+        if writerError is not None: # stop reading if the results cannot be printed
+            break
+        if line.startswith('#'): # skip header line
+            continue
+        line = line.strip()
+        columns = line.split(delimiter)
+        if len(columns) > 1: # check if line is not empty
+            locus = tuple(columns[:3])
+        else: # skip empty lines
+            continue
+        isNew = False
+        if locus in loci:
+            loci.move_to_end( locus )
+        else:
+            if args.chain:
+                result = liftOver( asm, locus )
+            else:
+                # look up previously converted query regions first
+                result = journalled.get( locus )
+                if result is None and cache is not None:
+                    result = cacheLookup( cache, asm, locus, cacheVersion, args.cache_ttl )
+                    if result is None:
+                        cacheMisses += 1
+                    else:
+                        cacheHits += 1
+                if result is None:
+                    if args.cache_only:
+                        result = dfv
+                    else:
+                        result = pool.submit( convertCoordinates, asm, locus )
+                        isNew = True
+            loci[locus] = result
+            if len( loci ) > lociSize:
+                loci.popitem( last=False )
+        if synchronous:
+            print( formatResult( locus, loci[locus] ) )
+        else:
+            rowQueue.put( ( locus, loci[locus], isNew ) )
+finally:
+    if not synchronous:
+        rowQueue.put( endOfInput )
+        writer.join()
+        pool.shutdown( cancel_futures=True )
+    # close file
+    if fhand1 is not sys.stdin:
+        fhand1.close()
+    if cache is not None:
+        cache.close()
+    if journal is not None:
+        journal.close()
+
+if writerError is not None:
+    raise writerError
+
+if args.cache_stats and cache is not None:
+    print( f'Cache: {cacheHits} hits, {cacheMisses} misses ({100 * cacheHits / max(cacheHits + cacheMisses, 1):.1f}% hit rate)', file=sys.stderr )
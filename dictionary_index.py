@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Compile a two-column dictionary file (tsv or csv) into a sorted, memory-mapped index file. convert_em1.py and replace_lines.py accept the index file in place of the dictionary: it opens in milliseconds, is shared between parallel jobs through the page cache and is searched with a binary search. The module also splits large query files into line-aligned chunks for the --workers mode of both tools."""
+
+# Modules to import
+######################################################################
+# Import command-line parsing module from the Python standard library.
+######################################################################
+import argparse
+# Standard library modules to build and memory-map the index
+import heapq
+import io
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from itertools import islice
+
+######################################################################
+# Index file format
+######################################################################
+# header:  MAGIC (8 bytes), number of records n (unsigned 64-bit integer)
+# offsets: n + 1 unsigned 64-bit integers (native byte order), the start
+#          of each record relative to the start of the data section
+# data:    records sorted by key (as UTF-8 bytes), each record being
+#          key + NUL + value. Keys that occur more than once keep the
+#          order of the dictionary file, so the first value comes first.
+MAGIC = b'CTDIDX1\x00'
+HEADER = struct.Struct('<8sQ')
+SEPARATOR = b'\x00'
+
+def is_index(fname):
+    """ Check if a file is a compiled dictionary index."""
+    try:
+        with open(fname, 'rb') as fhand:
+            return fhand.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+def read_dictionary(fhand, delimiter):
+    """ Yield (key, value) pairs from a two-column dictionary file. Exit with an error message if a line has fewer than two columns."""
+    for line in fhand:
+        line = line.rstrip()
+        columns = line.split(delimiter)
+        try:
+            k = columns[0]
+            v = columns[1]
+        except:
+            v = 'Check your dictionary file format.'
+            print( 'ERROR:', v)
+            exit()
+        yield (k, v)
+
+def compile_index(pairs, index_file, chunk_size=1000000):
+    """ Write (key, value) pairs to an index file. The pairs are sorted in chunks that are spilled to disk and merged, so memory use stays bounded."""
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(index_file))) as tmpdir:
+        # sorted runs of (key, sequence number, value) records
+        runs = []
+        seq = 0
+        pairs = iter(pairs)
+        while True:
+            chunk = [(k.encode('utf-8'), seq + i, v.encode('utf-8')) for i, (k, v) in enumerate(islice(pairs, chunk_size))]
+            if not chunk:
+                break
+            seq += len(chunk)
+            chunk.sort()
+            run_file = os.path.join(tmpdir, f'run{len(runs)}')
+            with open(run_file, 'wb') as run:
+                for k, s, v in chunk:
+                    run.write(struct.pack('<QII', s, len(k), len(v)) + k + v)
+            runs.append(run_file)
+
+        def read_run(run_file):
+            """ Yield the records of a sorted run."""
+            with open(run_file, 'rb') as run:
+                while True:
+                    head = run.read(16)
+                    if not head:
+                        break
+                    s, klen, vlen = struct.unpack('<QII', head)
+                    k = run.read(klen)
+                    yield (k, s, run.read(vlen))
+
+        # merge the runs into the data section and collect the record offsets
+        data_file = os.path.join(tmpdir, 'data')
+        offsets_file = os.path.join(tmpdir, 'offsets')
+        n = 0
+        position = 0
+        offsets = array('Q')
+        with open(data_file, 'wb') as data, open(offsets_file, 'wb') as offsets_out:
+            for k, s, v in heapq.merge(*(read_run(r) for r in runs)):
+                offsets.append(position)
+                record = k + SEPARATOR + v
+                data.write(record)
+                position += len(record)
+                n += 1
+                if len(offsets) >= 65536:
+                    offsets.tofile(offsets_out)
+                    offsets = array('Q')
+            offsets.append(position)
+            offsets.tofile(offsets_out)
+
+        # header + offsets + data
+        with open(index_file, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, n))
+            for part in (offsets_file, data_file):
+                with open(part, 'rb') as fhand:
+                    shutil.copyfileobj(fhand, out, 1 << 20)
+    return n
+
+class DictionaryIndex:
+    """ Read-only, memory-mapped view of a compiled dictionary index."""
+
+    def __init__(self, index_file):
+        with open(index_file, 'rb') as fhand:
+            self.mm = mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{index_file} is not a compiled dictionary index')
+        start = HEADER.size
+        self.data_start = start + 8 * (self.n + 1)
+        self.offsets = memoryview(self.mm)[start:self.data_start].cast('Q')
+
+    def key_at(self, i):
+        """ Get the key of the i-th record."""
+        start = self.data_start + self.offsets[i]
+        return self.mm[start:self.mm.find(SEPARATOR, start)]
+
+    def value_at(self, i):
+        """ Get the value of the i-th record."""
+        start = self.data_start + self.offsets[i]
+        return self.mm[self.mm.find(SEPARATOR, start) + 1:self.data_start + self.offsets[i + 1]].decode('utf-8')
+
+    def first(self, key):
+        """ Binary search for the position of the first record with a key, or -1 if the key is not in the index."""
+        k = key.encode('utf-8')
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key_at(mid) < k:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n and self.key_at(lo) == k:
+            return lo
+        return -1
+
+    def get(self, key, default=None):
+        """ Get the first value of a key, i.e. the value the first line of the dictionary file with that key gives."""
+        i = self.first(key)
+        return self.value_at(i) if i >= 0 else default
+
+    def get_all(self, key):
+        """ Get all the values of a key in dictionary file order."""
+        i = self.first(key)
+        values = []
+        if i < 0:
+            return values
+        k = key.encode('utf-8')
+        while i < self.n and self.key_at(i) == k:
+            values.append(self.value_at(i))
+            i += 1
+        return values
+
+    def keys(self):
+        """ Yield the distinct keys in sorted order."""
+        previous = None
+        for i in range(self.n):
+            k = self.key_at(i)
+            if k != previous:
+                yield k.decode('utf-8')
+                previous = k
+
+    def __contains__(self, key):
+        return self.first(key) >= 0
+
+    def __len__(self):
+        return self.n
+
+    def close(self):
+        self.offsets.release()
+        self.mm.close()
+
+######################################################################
+# Process a large query file in parallel, chunk by chunk
+######################################################################
+def chunk_ranges(fname, chunk_bytes):
+    """ Split a file into (start, end, is_last) byte ranges of about chunk_bytes, each ending at a line boundary."""
+    size = os.path.getsize(fname)
+    ranges = []
+    with open(fname, 'rb') as fhand:
+        start = 0
+        while start < size:
+            fhand.seek(min(start + chunk_bytes, size))
+            fhand.readline() # move on to the start of the next line
+            end = min(fhand.tell(), size)
+            ranges.append((start, end, end >= size))
+            start = end
+    if not ranges:
+        ranges.append((0, 0, True))
+    return ranges
+
+def read_chunk(fname, start, end):
+    """ Read a byte range of a file as text, the way open() would read it (default encoding and universal newlines)."""
+    with open(fname, 'rb') as fhand:
+        fhand.seek(start)
+        data = fhand.read(end - start)
+    return io.TextIOWrapper(io.BytesIO(data)).read()
+
+def map_chunks(worker, fname, workers, chunk_bytes=1 << 25):
+    """ Apply a worker function to the chunks of a file in worker processes and yield its results in file order.
+    The processes are forked, so they share the dictionary of the parent process (copy-on-write, or the pages of a memory-mapped index)."""
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        yield from pool.imap(worker, chunk_ranges(fname, chunk_bytes))
+
+if __name__ == '__main__':
+    ### Mandatory positional arguments
+    parser = argparse.ArgumentParser( description='Compile a dictionary file into a memory-mapped index file for convert_em1.py and replace_lines.py.' )
+    parser.add_argument( 'your_dictionary', help='Path to your dictionary file. FORMAT: Use two columns separated by tab (default) or comma (optional).' )
+    parser.add_argument( 'index_file', help='Path to the index file to be (over)written.' )
+
+    ### Optional arguments:
+    parser.add_argument('-s', '--chunk_size', help='Number of dictionary lines to sort in memory at a time (default: 1000000).', type=int, default=1000000)
+
+    ### Optional, but mutually exclusive user options:
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-c', '--csv', help='Use comma as column separator.', action='store_true')
+    group.add_argument('-t', '--tab', help='Use tab as column separator.', action='store_true')
+
+    args = parser.parse_args()
+
+    ### Input file format:
+    if args.csv:
+        delimiter = ',' #csv file format
+    else:
+        delimiter = '\t' #tsv file format
+
+    try:
+        fhand = open( args.your_dictionary )
+    except:
+        print('File cannot be opened:', args.your_dictionary)
+        exit()
+    with fhand:
+        n = compile_index(read_dictionary(fhand, delimiter), args.index_file, args.chunk_size)
+    print(f'Compiled {n} dictionary entries into {args.index_file}', file=sys.stderr)
@@ -10,21 +10,33 @@ __version__ = "0.01"
 # Import libraries to help work with JSON.
 import jmespath
 import json
+from collections import namedtuple
 
 ######################################################################
 # Import libraries to make API requests
 import requests
 
+######################################################################
+# Import standard library modules for batch mode
+import sys
+import timeit
+from urllib.parse import quote
+
 ######################################################################
 # Import command-line parsing module from the Python standard library.
 ######################################################################
 import argparse
 
 parser = argparse.ArgumentParser( description='You must provide either a Digital Object Identifier or a PMID to query Europe PMC in a format starting with either "DOI:" or "EXT_ID", respectively. Keyword parameters are case insensitive. For example "doi:10.1016/j.stem.2019.12.005" or "ext_id:31928944". For publication title queries, use syntax: \'TITLE:"Article title."\'', formatter_class=argparse.RawTextHelpFormatter )
-parser.add_argument( 'doi_OR_pmid', help='Use "doi:" for Digital Object Identifier queries. Use "ext_id:" for PMID queries.' )
+parser.add_argument( 'doi_OR_pmid', help='Use "doi:" for Digital Object Identifier queries. Use "ext_id:" for PMID queries.', nargs='?', default=None )
 
+### Optional arguments:
+parser.add_argument('-f', '--file', help='Batch mode: path to a file with one query per line (use - for standard input).\nDOI and EXT_ID queries are combined into as few API requests as possible.\nResults are printed as tab separated values.', default=None)
+parser.add_argument('--benchmark', help='Time the parsing of a recorded JSON response from the API (path to the file) and exit.', default=None)
 
 args = parser.parse_args()
+if [ args.doi_OR_pmid, args.file, args.benchmark ].count(None) != 2:
+    parser.error('provide either a single query, a --file of queries or a --benchmark response file')
 
 
 #################################################################
@@ -33,10 +45,29 @@ args = parser.parse_args()
 endpoint = 'https://www.ebi.ac.uk/europepmc/webservices/rest/search'
 # input argument
 queryString = args.doi_OR_pmid
+# batch mode: longest combined query string to send in one request (URL encoded)
+maxQueryLength = 4000
+# batch mode: number of results per page (maximum allowed by the API)
+batchPageSize = 1000
 
 
 # endpoint example string: "https://api.ingest.archive.data.humancellatlas.org/submissionEnvelopes/5d1c67c688fa640008aff7cc/biomaterials"
 
+#################################################################
+### Extract the fields of interest from every hit in a single pass
+#################################################################
+Hit = namedtuple('Hit', ['title', 'pmid', 'pmcid', 'doi', 'source', 'year'])
+# compiled once, at module load
+resultListPath = jmespath.compile('resultList.result')
+
+def extractHits(data):
+    """ Get a list of Hit records from the JSON returned by the API in a single walk over the results."""
+    return([ Hit(r.get('title'), r.get('pmid'), r.get('pmcid'), r.get('doi'), r.get('source'), r.get('pubYear')) for r in resultListPath.search(data) or [] ])
+
+def hitFields(hits, field):
+    """ Get the values of a field from a list of hits, skipping missing values."""
+    return([ getattr(h, field) for h in hits if getattr(h, field) is not None ])
+
 
 def doi2pmid(query):
     """ Query Europe PMC API using a DOI. Return the associated PMID if it exists in the JSON returned by the API."""
@@ -49,10 +80,10 @@ def doi2pmid(query):
     }
     response = requests.get(endpoint, params = parameters)
 #   print('endpoint:', response.url)
-    data = response.json()
-    foundTITLEs = jmespath.search('resultList.result[*].title', data)
-    foundPMIDs = jmespath.search('resultList.result[*].pmid', data)
-    foundDOIs = jmespath.search('resultList.result[*].doi', data)
+    hits = extractHits(response.json())
+    foundTITLEs = hitFields(hits, 'title')
+    foundPMIDs = hitFields(hits, 'pmid')
+    foundDOIs = hitFields(hits, 'doi')
     if len(foundTITLEs) == 1: # check if there is a single hit or not
         foundTitle = foundTITLEs[0]
     else:
@@ -68,4 +99,125 @@ def doi2pmid(query):
     results = { 'TITLE' : foundTitle, 'PMID' : foundPMID, 'DOI' : foundDOI }
     return(results)
 
-print ( 'Query:', queryString, 'Results:', doi2pmid(queryString))
+def searchAll(session, query):
+    """ Query Europe PMC API and page through all the results with cursorMark. Yield the hits one by one."""
+    parameters = {
+    'query' : query,
+    'resultType' : 'lite',
+    'cursorMark' : '*',
+    'pageSize' : batchPageSize,
+    'format' : 'json'
+    }
+    while True:
+        response = session.get(endpoint, params = parameters)
+        response.raise_for_status()
+        data = response.json()
+        page = extractHits(data)
+        yield from page
+        nextCursorMark = data.get('nextCursorMark')
+        if len(page) < batchPageSize or not nextCursorMark or nextCursorMark == parameters['cursorMark']:
+            break
+        parameters['cursorMark'] = nextCursorMark
+
+def parseQuery(query):
+    """ Split a query into a (FIELD, value) pair if it can be batched (DOI or EXT_ID), otherwise return None."""
+    field, sep, value = query.partition(':')
+    field = field.strip().upper()
+    value = value.strip().strip('"')
+    if sep and value and field in ('DOI', 'EXT_ID'):
+        return((field, value))
+    return(None)
+
+def batchQueries(parsedQueries):
+    """ Pack (FIELD, value) pairs into OR-joined query strings no longer than maxQueryLength once URL encoded."""
+    batch = []
+    length = 0
+    for field, value in parsedQueries:
+        term = f'{field}:"{value}"'
+        termLength = len(quote(term)) + len(quote(' OR '))
+        if batch and length + termLength > maxQueryLength:
+            yield batch
+            batch = []
+            length = 0
+        batch.append((field, value))
+        length += termLength
+    if batch:
+        yield batch
+
+def resultKeys(hit):
+    """ Get the batch lookup keys a search result can answer."""
+    keys = []
+    if hit.doi:
+        keys.append(('DOI', hit.doi.lower()))
+    if hit.pmid:
+        keys.append(('EXT_ID', str(hit.pmid)))
+    return(keys)
+
+def formatField(values):
+    """ Format a list of values found for a query as a single TSV field."""
+    return(';'.join(str(v) for v in values if v is not None))
+
+def doi2pmidBatch(queries):
+    """ Query Europe PMC API with many DOIs or PMIDs at once. Yield (query, results) pairs in input order."""
+    session = requests.Session()
+    parsed = {}
+    for query in queries:
+        p = parseQuery(query)
+        if p is not None:
+            parsed[(p[0], p[1].lower() if p[0] == 'DOI' else p[1])] = p
+    # look up the DOIs and PMIDs with OR-joined queries
+    hits = {}
+    for batch in batchQueries(parsed.values()):
+        combined = ' OR '.join(f'{field}:"{value}"' for field, value in batch)
+        for hit in searchAll(session, combined):
+            for key in resultKeys(hit):
+                if key in parsed: # the same result can be found by more than one batch
+                    hits.setdefault(key, {})[hit] = hit
+    for query in queries:
+        p = parseQuery(query)
+        if p is None: # for example a TITLE query
+            yield (query, doi2pmid(query))
+            continue
+        found = list(hits.get((p[0], p[1].lower() if p[0] == 'DOI' else p[1]), {}).values())
+        yield (query, { 'TITLE' : hitFields(found, 'title'), 'PMID' : hitFields(found, 'pmid'), 'DOI' : hitFields(found, 'doi') })
+
+def benchmark(responseFile, repeat = 1000):
+    """ Compare the parsing cost per response of three separate jmespath searches with the single-pass extractor."""
+    with open(responseFile, encoding='utf-8') as fhand:
+        text = fhand.read()
+    data = json.loads(text)
+    timings = {
+    'json.loads': lambda: json.loads(text),
+    'three jmespath.search calls': lambda: ( jmespath.search('resultList.result[*].title', data), jmespath.search('resultList.result[*].pmid', data), jmespath.search('resultList.result[*].doi', data) ),
+    'compiled single-pass extractor': lambda: extractHits(data),
+    }
+    print(f'{len(extractHits(data))} hits, {len(text)} bytes per response')
+    for name, f in timings.items():
+        seconds = min(timeit.repeat(f, number = repeat, repeat = 5)) / repeat
+        print(f'{name}:\t{seconds * 1e6:.1f} microseconds per response')
+
+if args.benchmark is not None:
+    benchmark(args.benchmark)
+elif args.file is None:
+    print ( 'Query:', queryString, 'Results:', doi2pmid(queryString))
+else:
+    if args.file == '-':
+        fhand = sys.stdin
+    else:
+        try:
+            fhand = open( args.file )
+        except:
+            print('File cannot be opened:', args.file)
+            exit()
+    queries = []
+    for line in fhand:
+        line = line.strip()
+        if not line or line.startswith('#'): # skip empty and comment lines
+            continue
+        queries.append(line)
+    if fhand is not sys.stdin:
+        fhand.close()
+    print('Query\tTITLE\tPMID\tDOI')
+    for query, results in doi2pmidBatch(queries):
+        fields = [ results[k] if isinstance(results[k], list) else [results[k]] for k in ('TITLE', 'PMID', 'DOI') ]
+        print(query, *(formatField(f) for f in fields), sep='\t')
@@ -10,6 +10,7 @@ __version__ = "0.1"
 ######################################################################
 import argparse # command-line parsing module from the Python standard library
 import json # serialize, de-serialize, etc., JSON
+from collections import Counter # count unique label/text pairs
 
 ######################################################################
 # Obtain user input
@@ -35,35 +36,74 @@ if args.pmcid == "use_filename_as_id":
 ######################################################################
 # Read in json data
 ######################################################################
-with open(fname, mode="r", encoding="utf-8") as input_file:
-    json_data = json.load(input_file)
+def iter_tasks(fhand, chunk_size=1 << 20):
+    """ Yield the tasks of a label studio JSON export (the elements of its top-level list) one at a time.
+    The file is read in chunks and each task is decoded as soon as it is complete, so memory use depends on the size of the largest task, not of the file."""
+    decoder = json.JSONDecoder()
+    buffer = fhand.read(chunk_size)
+    eof = not buffer
+    position = 0
+    expected = '['
+    while True:
+        # skip white space, reading more of the file if needed
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n':
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            buffer = fhand.read(chunk_size)
+            position = 0
+            eof = not buffer
+        if position == len(buffer):
+            raise ValueError('unexpected end of the JSON file')
+        c = buffer[position]
+        if expected == '[':
+            if c != '[':
+                raise ValueError('a label studio JSON export must be a list of tasks')
+            position += 1
+            expected = 'task or ]'
+            continue
+        if c == ']' and expected != 'task':
+            return
+        if expected == ', or ]':
+            if c != ',':
+                raise ValueError(f'expected , or ] between the tasks, found {c!r}')
+            position += 1
+            expected = 'task'
+            continue
+        # decode the next task, reading more of the file until it is complete
+        size = chunk_size
+        while True:
+            try:
+                task, position = decoder.raw_decode(buffer, position)
+                break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = fhand.read(size)
+                size *= 2
+                eof = not more
+                buffer = buffer[position:] + more
+                position = 0
+        yield task
+        expected = ', or ]'
+        # drop what has been parsed
+        if position >= chunk_size:
+            buffer = buffer[position:]
+            position = 0
 
 ######################################################################
 # parse json data
 ######################################################################
-# create an empty list for the results
-results = []
-# extract selected fields of interest
+# count unique label/text pairs task by task
 ### strip whitespace from labelled text span
-for i in json_data:
-    for j in i["annotations"]:
-        for k in j["result"]:
-            for l in k["value"]["labels"]:
-#               print(f'{pmcid}\t{l}\t"{k["value"]["text"]}"' ) # use double quote marks to surround text spans
-                results.append('\t'.join([l, k["value"]["text"].strip()]))
-
-# create an empty dictionary for counting unique text spans
-counts = {}
-# count unique label/text pairs 
-for r in results:
-    if r not in counts:
-        counts[r] = 1
-    else:
-        counts[r] += 1
-
-# test print unsorted counts:
-#for key in counts:
-#    print(f'{pmcid}\t{key}\t{counts[key]}')
+counts = Counter()
+with open(fname, mode="r", encoding="utf-8") as input_file:
+    for i in iter_tasks(input_file):
+        for j in i["annotations"]:
+            for k in j["result"]:
+                for l in k["value"]["labels"]:
+                    counts[(l, k["value"]["text"].strip())] += 1
 
 # sort counts
 sorted_counts = sorted(counts.items())
@@ -75,5 +115,5 @@ sorted_counts = sorted(counts.items())
 print(f'PUB_ID\tTEXT\tLABEL\tCOUNT')
 
 # print sorted results as tab separated fields
-for e in sorted_counts:
-    print(f'{pmcid}\t{e[0]}\t{e[1]}')
+for (label, text), count in sorted_counts:
+    print(f'{pmcid}\t{label}\t{text}\t{count}')
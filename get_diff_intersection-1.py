@@ -1,6 +1,6 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
-""" Get the differences/agreements between lists/sets. You need to provide two plain text files that contain your desired lists in a format of one list element per line. """
+""" Get the differences/agreements between lists/sets. You need to provide two (or more) plain text files that contain your desired lists in a format of one list element per line. """
 
 __author__  = "Ray Stefancsik"
 __version__ = "1.0"
@@ -11,11 +11,24 @@ __version__ = "1.0"
 #########################################################################
 import argparse
 import sys
+# Standard library modules for set expressions over many lists
+import ast
+import math
+from collections import Counter
+# Standard library modules for the external-memory mode
+import heapq
+import os
+import shutil
+import tempfile
+from itertools import islice, combinations
+# HyperLogLog and MinHash sketches for the --sketch mode (see set_sketch.py)
+from set_sketch import SetSketch, is_sketch
 
 ### Mandatory positional arguments
 parser = argparse.ArgumentParser( description='1. Take two sets of elements as lists. 2. Find the shared and non-shared elements in the two sets. 3. Print the results to standard output.' )
 parser.add_argument( 'your_list1', help='Path to your first data file. FORMAT: Use a plain text file with one list element per line. Lines that start with # are ignored.' )
 parser.add_argument( 'your_list2', help='Path to your first data file. FORMAT: Use a plain text file with one list element per line. Lines that start with # are ignored.' )
+parser.add_argument( 'more_lists', help='Paths to further data files to compare with --regions, --matrix or --expression. The lists are called A, B, C, ... in the order given, unless --names are given.', nargs='*' )
 
 ### Optional, but mutually exclusive user options:
 group = parser.add_mutually_exclusive_group()
@@ -23,9 +36,325 @@ group.add_argument('-1', '--only_in_1st', help='Get the elements that are found
 group.add_argument('-2', '--only_in_2nd', help='Get the elements that are found only in the second set.', action='store_true')
 group.add_argument('-i', '--intersection', help='Get the elements that are found in both sets.', action='store_true')
 
+### Optional arguments:
+parser.add_argument('-x', '--external', help='Sort each list on disk and find the differences and the intersection in one merge pass, so that lists larger than the memory can be compared. The output is the same.', action='store_true')
+parser.add_argument('-s', '--chunk_size', help='Number of lines to sort in memory at a time with --external (default: 1000000).', type=int, default=1000000)
+parser.add_argument('-r', '--regions', help='Print the size of each list and the number of elements in each combination of lists, i.e. in exactly those lists and no other (UpSet-style regions). This is the default with more than two lists.', action='store_true')
+parser.add_argument('-M', '--matrix', help='Print a membership matrix: one row per element with a 1 or 0 column for each list.', action='store_true')
+parser.add_argument('-e', '--expression', help='Get the elements of a set expression over the list names, e.g. "(A & B) - C". Operators: & (intersection), | (union), - (difference) and ^ (symmetric difference), with the Python precedence (- before &, ^ and |). Can be used more than once.', action='append')
+parser.add_argument('-n', '--names', help='Comma-separated names for the lists in the order given (default: A,B,C,...).')
+parser.add_argument('-c', '--count_only', help='Print the number of elements of each section or expression instead of the elements.', action='store_true')
+parser.add_argument('-k', '--sketch', help='Estimate the sizes of the lists and of their differences, intersections and unions, and their Jaccard similarity, from HyperLogLog and MinHash sketches of a few KB each, with 95%% error bounds. Any of the lists can also be a sketch saved with --sketch_dir.', action='store_true')
+parser.add_argument('-o', '--sketch_dir', help='With --sketch, save the sketch of each list file as DIR/<file name>.sketch for later comparisons.', metavar='DIR')
+parser.add_argument('--precision', help='HyperLogLog precision p of new sketches, i.e. 2**p registers (default: 11, about 2.3%% standard error).', type=int, default=11)
+parser.add_argument('--minhash_size', help='Number of hash values kept by the MinHash sketches (default: 512).', type=int, default=512)
+parser.add_argument('-T', '--tmp_dir', help='Directory for the temporary files of --external (default: the system temporary directory).')
+
 ######################################################################
 # parse input data files
 args = parser.parse_args()
+if args.chunk_size < 1:
+    parser.error('--chunk_size must be at least 1')
+
+fnames = [args.your_list1, args.your_list2] + args.more_lists
+if args.sketch and (args.external or args.regions or args.matrix or args.expression or args.only_in_1st or args.only_in_2nd or args.intersection):
+    parser.error('--sketch reports estimates only; it cannot be used with --external, --regions, --matrix, --expression, -1, -2 or -i')
+if args.sketch_dir and not args.sketch:
+    parser.error('--sketch_dir needs --sketch')
+if not 4 <= args.precision <= 18:
+    parser.error('--precision must be from 4 to 18')
+if args.minhash_size < 1:
+    parser.error('--minhash_size must be at least 1')
+multi = bool(args.more_lists or args.regions or args.matrix or args.expression) and not args.sketch
+if multi and (args.only_in_1st or args.only_in_2nd or args.intersection):
+    parser.error('-1, -2 and -i compare two lists; use --expression with --regions, --matrix or more than two lists')
+if multi and args.external:
+    parser.error('--external compares two lists only')
+if args.matrix and args.count_only:
+    parser.error('--matrix cannot be used with --count_only')
+
+if args.names:
+    names = args.names.split(',')
+    if len(names) != len(fnames):
+        parser.error(f'--names has {len(names)} names for {len(fnames)} lists')
+    if len(set(names)) != len(names) or not all(name.isidentifier() for name in names):
+        parser.error('--names must be distinct and made of letters, digits and underscores (not starting with a digit)')
+elif len(fnames) <= 26:
+    names = [chr(ord('A') + i) for i in range(len(fnames))]
+else:
+    names = [f'L{i + 1}' for i in range(len(fnames))]
+
+#########################################################################
+# Set algebra over any number of lists: each list is read once into one
+# dictionary from each distinct element to a bit mask of the lists it is
+# in. A set expression is a function of that mask, so it is evaluated
+# once per combination of lists (region), not once per element.
+#########################################################################
+SET_OPERATORS = {
+    ast.BitAnd: lambda a, b: a and b,
+    ast.BitOr: lambda a, b: a or b,
+    ast.Sub: lambda a, b: a and not b,
+    ast.BitXor: lambda a, b: a != b,
+    }
+
+def compile_expression(expression, names):
+    """ Turn a set expression over list names into a function of a membership bit mask (bit i for the i-th list). Raise ValueError if the expression is not valid."""
+    try:
+        tree = ast.parse(expression.strip(), mode='eval').body
+    except SyntaxError:
+        raise ValueError(f'cannot parse the expression: {expression}')
+    def check(node):
+        if isinstance(node, ast.Name):
+            if node.id not in names:
+                raise ValueError(f'unknown list name {node.id} in the expression: {expression}')
+        elif isinstance(node, ast.BinOp) and type(node.op) in SET_OPERATORS:
+            check(node.left)
+            check(node.right)
+        else:
+            raise ValueError(f'only list names, parentheses and the operators & | - ^ are allowed in the expression: {expression}')
+    check(tree)
+    def evaluate(node, mask):
+        if isinstance(node, ast.Name):
+            return bool(mask >> names.index(node.id) & 1)
+        return SET_OPERATORS[type(node.op)](evaluate(node.left, mask), evaluate(node.right, mask))
+    return lambda mask: evaluate(tree, mask)
+
+def read_memberships(fnames):
+    """ Read list files into a dictionary from each distinct element to the bit mask of the lists it is in."""
+    membership = dict()
+    for i, fname in enumerate(fnames):
+        bit = 1 << i
+        with open_list(fname) as fhand:
+            for line in fhand:
+                if line.startswith('#'): # skip header lines
+                    continue
+                e = line.rstrip()
+                membership[e] = membership.get(e, 0) | bit
+    return membership
+
+def region_name(mask):
+    """ Get the name of a region, e.g. A&C for the elements in the first and third lists only."""
+    return '&'.join(name for i, name in enumerate(names) if mask >> i & 1)
+
+def print_sections(sections, membership, regions):
+    """ Print the elements, or with --count_only the number of elements, of (title, function of the mask) sections."""
+    for n, (title, predicate) in enumerate(sections):
+        print(('\n' if n else '') + title)
+        selected = {mask for mask in regions if predicate(mask)}
+        if args.count_only:
+            print(sum(regions[mask] for mask in selected))
+        else:
+            for e in sorted(e for e, mask in membership.items() if mask in selected):
+                print(e)
+
+#########################################################################
+# External-memory mode: sort each list in chunks that are spilled to disk
+# as runs, merge the runs into one sorted stream of distinct elements per
+# list and walk the two streams side by side.
+#########################################################################
+# maximum number of runs merged (and files open) at a time
+FAN_IN = 256
+
+def open_list(fname):
+    """ Open a list file, or exit with an error message."""
+    try:
+        return open( fname )
+    except:
+        print('File cannot be opened:', fname)
+        exit()
+
+def write_run(elements, tmpdir):
+    """ Write sorted elements to a new run file."""
+    fd, run = tempfile.mkstemp(dir=tmpdir, suffix='.run')
+    with open(fd, 'w', newline='\n') as out:
+        out.writelines(e + '\n' for e in elements)
+    return run
+
+def read_run(run):
+    """ Yield the elements of a run file."""
+    with open(run, newline='\n') as fhand:
+        for line in fhand:
+            yield line[:-1]
+
+def unique(elements):
+    """ Drop repeated elements from a sorted stream."""
+    previous = None
+    for e in elements:
+        if e != previous:
+            yield e
+            previous = e
+
+def sorted_runs(fhand, tmpdir, chunk_size):
+    """ Split the elements of a list file into sorted runs of distinct elements."""
+    elements = (line.rstrip() for line in fhand if not line.startswith('#')) # skip header lines
+    runs = []
+    while True:
+        chunk = sorted(set(islice(elements, chunk_size)))
+        if not chunk:
+            break
+        runs.append(write_run(chunk, tmpdir))
+    return runs
+
+def merge_runs(runs, tmpdir):
+    """ Yield the distinct elements of sorted runs in sorted order. Runs are merged FAN_IN at a time, so only so many files are open."""
+    while len(runs) > FAN_IN:
+        group, runs = runs[:FAN_IN], runs[FAN_IN:]
+        runs.append(write_run(unique(heapq.merge(*map(read_run, group))), tmpdir))
+        for run in group:
+            os.remove(run)
+    return unique(heapq.merge(*map(read_run, runs)))
+
+def compare_sorted(elements1, elements2):
+    """ Yield (element, 1), (element, 2) or (element, 0) for elements only in the 1st, only in the 2nd or in both sorted streams of distinct elements."""
+    elements1 = iter(elements1)
+    elements2 = iter(elements2)
+    e1 = next(elements1, None)
+    e2 = next(elements2, None)
+    while e1 is not None and e2 is not None:
+        if e1 < e2:
+            yield (e1, 1)
+            e1 = next(elements1, None)
+        elif e2 < e1:
+            yield (e2, 2)
+            e2 = next(elements2, None)
+        else:
+            yield (e1, 0)
+            e1 = next(elements1, None)
+            e2 = next(elements2, None)
+    while e1 is not None:
+        yield (e1, 1)
+        e1 = next(elements1, None)
+    while e2 is not None:
+        yield (e2, 2)
+        e2 = next(elements2, None)
+
+#########################################################################
+# Sketch mode: stream each list once into a HyperLogLog and a MinHash
+# sketch and compare the sketches
+#########################################################################
+def estimate(value, error):
+    """ Format an estimate with its error bound."""
+    return f'{round(value)} ± {round(error)}'
+
+if args.sketch:
+    sketches = []
+    for fname in fnames:
+        if is_sketch(fname):
+            sketch = SetSketch.load(fname)
+        else:
+            sketch = SetSketch(args.precision, args.minhash_size)
+            with open_list(fname) as fhand:
+                sketch.update(line.rstrip() for line in fhand if not line.startswith('#')) # skip header lines
+            if args.sketch_dir:
+                sketch.save(os.path.join(args.sketch_dir, os.path.basename(fname) + '.sketch'))
+        sketches.append(sketch)
+    for sketch in sketches[1:]:
+        try:
+            sketches[0].check_compatible(sketch)
+        except ValueError as error:
+            print('ERROR:', error)
+            exit()
+
+    print("#### estimated sizes:")
+    for name, fname, sketch in zip(names, fnames, sketches):
+        print(name, estimate(*sketch.cardinality()), fname, sep='\t')
+
+    for (name1, sketch1), (name2, sketch2) in combinations(zip(names, sketches), 2):
+        j, j_error = sketch1.jaccard(sketch2)
+        size1, size1_error = sketch1.cardinality()
+        size2, size2_error = sketch2.cardinality()
+        union, union_error = sketch1.union(sketch2).cardinality()
+        common = j * union
+        common_error = math.hypot(j * union_error, union * j_error)
+        print(f"\n#### {name1} vs {name2}:")
+        print("only in 1st", estimate(max(size1 - common, 0), math.hypot(size1_error, common_error)), sep='\t')
+        print("only in 2nd", estimate(max(size2 - common, 0), math.hypot(size2_error, common_error)), sep='\t')
+        print("common elements", estimate(common, common_error), sep='\t')
+        print("union", estimate(union, union_error), sep='\t')
+        print("jaccard", f'{j:.3f} ± {j_error:.3f}', sep='\t')
+    sys.exit()
+
+if multi:
+    predicates = []
+    for expression in args.expression or []:
+        try:
+            predicates.append((f'#### {expression.strip()}:', compile_expression(expression, names)))
+        except ValueError as error:
+            parser.error(str(error))
+
+    membership = read_memberships(fnames)
+    regions = Counter(membership.values()) # mask -> number of elements
+
+    if args.regions or not (args.matrix or args.expression):
+        print("#### list sizes:")
+        for i, (name, fname) in enumerate(zip(names, fnames)):
+            size = sum(count for mask, count in regions.items() if mask >> i & 1)
+            print(name, size, fname, sep='\t')
+        print("\n#### regions:")
+        for mask, count in sorted(regions.items(), key=lambda x: (-x[1], x[0])):
+            print(region_name(mask), count, sep='\t')
+        if args.matrix or args.expression:
+            print()
+
+    if args.matrix:
+        print('#ELEMENT', *names, sep='\t')
+        for e in sorted(membership):
+            mask = membership[e]
+            print(e, *(mask >> i & 1 for i in range(len(names))), sep='\t')
+        if args.expression:
+            print()
+
+    print_sections(predicates, membership, regions)
+    sys.exit()
+
+# the sections of a comparison of two lists, as functions of the membership mask
+two_list_sections = (
+    (args.only_in_1st, 1, "#### only in 1st:", lambda mask: mask == 1),
+    (args.only_in_2nd, 2, "#### only in 2nd:", lambda mask: mask == 2),
+    (args.intersection, 0, "#### common elements:", lambda mask: mask == 3),
+    )
+
+if args.count_only and not args.external:
+    membership = read_memberships(fnames)
+    selected = [(title, predicate) for requested, _, title, predicate in two_list_sections if requested]
+    print_sections(selected or [(title, predicate) for _, _, title, predicate in two_list_sections], membership, Counter(membership.values()))
+    sys.exit()
+
+if args.external:
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmpdir:
+        sorted_lists = []
+        for fname in (args.your_list1, args.your_list2):
+            with open_list(fname) as fhand:
+                sorted_lists.append(merge_runs(sorted_runs(fhand, tmpdir, args.chunk_size), tmpdir))
+
+        if args.count_only:
+            counts = Counter(where for _, where in compare_sorted(*sorted_lists))
+            selected = [(title, where) for requested, where, title, _ in two_list_sections if requested]
+            for n, (title, where) in enumerate(selected or [(title, where) for _, where, title, _ in two_list_sections]):
+                print(('\n' if n else '') + title)
+                print(counts[where])
+            sys.exit() # stop here
+
+        # requested section only: straight to standard output
+        for selected, where, title, _ in two_list_sections:
+            if selected:
+                print(title)
+                sys.stdout.writelines(e + '\n' for e, w in compare_sorted(*sorted_lists) if w == where)
+                sys.exit() # stop here
+
+        # all three sections: write them to files in one pass, then print them in order
+        sections = [os.path.join(tmpdir, name) for name in ('only_in_1', 'only_in_2', 'common')]
+        outs = {where: open(section, 'w', newline='\n') for where, section in zip((1, 2, 0), sections)}
+        for e, where in compare_sorted(*sorted_lists):
+            outs[where].write(e + '\n')
+        for out in outs.values():
+            out.close()
+        for title, section in zip(("#### only in 1st:", "\n#### only in 2nd:", "\n#### common elements:"), sections):
+            print(title)
+            sys.stdout.flush()
+            with open(section, newline='\n') as fhand:
+                shutil.copyfileobj(fhand, sys.stdout)
+    sys.exit()
 
 # data input filenames
 
@@ -18,6 +18,15 @@ import json
 import argparse
 # To help produce tsv output
 import csv
+# To fetch the phenotypes of several diseases at once
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# To keep the best scoring pairs of each disease and to merge sorted runs
+import heapq
+# To write compressed output and to spill sorted runs to disk
+import gzip
+import tempfile
+import os
+from itertools import islice
 ######################################################################
 
 # input filename
@@ -29,16 +38,38 @@ parser = argparse.ArgumentParser( description='Provide a text file with a list o
 parser.add_argument( 'input_file', help='Path to your input file.' )
 
 ### Optional arguments:
-parser.add_argument('-o', '--outfile', help='Path to your desired output tsv file to be (over)written.', nargs='?', default=None, const=None) # you need both the default and const for different scenarios (1. no flag and no user input, 2. flag only without any other user input, 3. flag plus user input. see https://docs.python.org/3/library/argparse.html
+parser.add_argument('-o', '--outfile', help='Path to your desired output tsv file to be (over)written. Use a .gz extension for gzip compressed output.', nargs='?', default=None, const=None) # you need both the default and const for different scenarios (1. no flag and no user input, 2. flag only without any other user input, 3. flag plus user input. see https://docs.python.org/3/library/argparse.html
 
 ### Optional, but mutually exclusive user option:
 group = parser.add_mutually_exclusive_group()
 group.add_argument('-s', '--sort_results', help='Sort results by descending Jaccard score.', action='store_true')
 
+### Optional, but mutually exclusive phenotype sources for local Jaccard computation:
+group2 = parser.add_mutually_exclusive_group()
+group2.add_argument('-l', '--local', help='Fetch the phenotypes of each disease once from the BioLink API and compute all Jaccard scores locally\n(instead of one API call per disease pair).', action='store_true')
+group2.add_argument('-a', '--annotations', help='Compute all Jaccard scores locally from a disease to phenotype annotation file, without any API calls.\nFORMAT: tab separated, disease identifier in the first column and phenotype identifier in the second column,\nor the HPO phenotype.hpoa format (with the database_id and hpo_id header).', default=None)
+parser.add_argument('-k', '--top_k', help='Only keep the N most similar diseases of each disease (with --local or --annotations).', type=int, default=None)
+parser.add_argument('-m', '--min_jaccard', help='Only keep disease pairs with a Jaccard score of at least T (with --local or --annotations).', type=float, default=None)
+parser.add_argument('-c', '--chunk_size', help='Number of results to hold in memory at a time when writing or sorting results (default: 1000000).\nLarger result sets are sorted on disk.', type=int, default=1000000)
+parser.add_argument('-j', '--journal', help='Path to a checkpoint journal (JSON lines) of the finished API requests (phenotype sets with --local, Jaccard scores otherwise).', default=None)
+parser.add_argument('-r', '--resume', help='Reuse the API results in the --journal of an interrupted run and only make the remaining requests.', action='store_true')
+parser.add_argument('-w', '--workers', help='Number of concurrent BioLink API requests with --local (default: 4).', type=int, default=4)
+
 args = parser.parse_args()
 # input filename
 fname = args.input_file
 
+if args.workers < 1:
+    parser.error('--workers must be at least 1')
+if ( args.top_k is not None or args.min_jaccard is not None ) and not ( args.local or args.annotations ):
+    parser.error('--top_k and --min_jaccard require --local or --annotations')
+if args.top_k is not None and args.top_k < 1:
+    parser.error('--top_k must be at least 1')
+if args.chunk_size < 1:
+    parser.error('--chunk_size must be at least 1')
+if args.resume and not args.journal:
+    parser.error('--resume requires --journal')
+
 #################################################################
 # Read in a data file.
 #################################################################
@@ -59,7 +90,7 @@ for line in fhand1:
 fhand1.close()
 
 # Get the set of unique disease pairs
-disease_pairs = [(disease_ids[i], disease_ids[j]) for i in range(len(disease_ids)) for j in range(i+1, len(disease_ids))]
+disease_pairs = ((disease_ids[i], disease_ids[j]) for i in range(len(disease_ids)) for j in range(i+1, len(disease_ids)))
 
 def jaccard (disease1, disease2):
     """ Accesses the BioLink API (https://api.monarchinitiative.org/api/) to obtain a pairwise Jaccard score"""
@@ -70,26 +101,241 @@ def jaccard (disease1, disease2):
     BIOLINK_API_JACQUARD_URL = "https://api.monarchinitiative.org/api/pair/sim/jaccard/"
     BIOLINK_API_JACQUARD_QUERY_URL = BIOLINK_API_JACQUARD_URL + requests.utils.quote(disease1 + "/" + disease2)
     response = requests.get(BIOLINK_API_JACQUARD_QUERY_URL)
+    response.raise_for_status() # do not take an error page (e.g. 429 or 5xx) for a score
     return(response.text)
 
-# compute results
-results = [ ['disease_1', 'disease_2', 'jaccard'] ]
-for i in disease_pairs:
-    similarity = jaccard(i[0], i[1])
-    results.append([i[0], i[1], similarity.strip()])
-
-# sort results by descending Jaccard score
-if args.sort_results:
-    results.sort(key = lambda x: x[2], reverse = True)
-#else:
-#    print("Not sorting.")
-
-if args.outfile == None:
-    for r in results:
-        print(*r) # using the '*' or 'splat' operator
+# reuse the connection for all phenotype requests
+session = requests.Session()
+
+def get_phenotypes (disease):
+    """ Accesses the BioLink API (https://api.monarchinitiative.org/api/) to obtain the set of phenotypes associated with a disease"""
+
+    # Get disease phenotypes example
+    # https://api.monarchinitiative.org/api/bioentity/disease/MONDO%3A0007947/phenotypes?rows=500&start=0
+    BIOLINK_API_PHENOTYPES_URL = "https://api.monarchinitiative.org/api/bioentity/disease/" + requests.utils.quote(disease) + "/phenotypes"
+    phenotypes = set()
+    start = 0
+    rows = 500
+    while True:
+        response = session.get(BIOLINK_API_PHENOTYPES_URL, params = {'rows': rows, 'start': start})
+        response.raise_for_status()
+        data = response.json()
+        associations = data.get('associations') or []
+        phenotypes.update(a['object']['id'] for a in associations)
+        start += rows
+        if len(associations) < rows or start >= data.get('numFound', 0):
+            break
+    return(phenotypes)
+
+def read_annotations (annotation_file):
+    """ Read a disease to phenotype annotation file into a dictionary of disease -> set of phenotypes"""
+    annotations = {}
+    disease_column = 0
+    phenotype_column = 1
+    qualifier_column = None
+    with open(annotation_file) as fhand:
+        for line in fhand:
+            if line.startswith('#'): # skip comments
+                continue
+            columns = line.rstrip('\n').split('\t')
+            if 'hpo_id' in columns: # phenotype.hpoa header line
+                disease_column = columns.index('database_id')
+                phenotype_column = columns.index('hpo_id')
+                qualifier_column = columns.index('qualifier') if 'qualifier' in columns else None
+                continue
+            if len(columns) <= max(disease_column, phenotype_column):
+                continue
+            if qualifier_column is not None and columns[qualifier_column] == 'NOT': # negated annotation
+                continue
+            annotations.setdefault(columns[disease_column], set()).add(columns[phenotype_column])
+    return(annotations)
+
+def local_jaccard (phenotypes):
+    """ Compute the pairwise Jaccard scores of all unique disease pairs from their phenotype sets.
+    Each phenotype set is packed into the bits of an integer, so that the size of an intersection is a bitwise AND and a bit count."""
+    phenotype_index = {}
+    bitsets = []
+    for disease in disease_ids:
+        bits = 0
+        for phenotype in phenotypes.get(disease, ()):
+            bits |= 1 << phenotype_index.setdefault(phenotype, len(phenotype_index))
+        bitsets.append(bits)
+    sizes = [bits.bit_count() for bits in bitsets]
+    for i in range(len(disease_ids)):
+        bits_i = bitsets[i]
+        size_i = sizes[i]
+        for j in range(i+1, len(disease_ids)):
+            shared = (bits_i & bitsets[j]).bit_count()
+            union = size_i + sizes[j] - shared
+            yield (disease_ids[i], disease_ids[j], shared / union if union else 0.0)
+
+def pruned_jaccard (phenotypes, min_jaccard, top_k):
+    """ Compute the Jaccard scores of the disease pairs that share at least one phenotype, using an inverted index from phenotype to diseases.
+    Only pairs scoring at least min_jaccard are kept and, if top_k is given, only the top_k best scoring pairs of each disease."""
+    sets = [phenotypes.get(disease, set()) for disease in disease_ids]
+    index = {}
+    for i, phenotype_set in enumerate(sets):
+        for phenotype in phenotype_set:
+            index.setdefault(phenotype, []).append(i)
+    # a bounded min-heap of (score, -partner) per disease
+    heaps = [[] for i in disease_ids]
+    def scored_pairs():
+        """ Yield (i, j, score) for i < j, counting the shared phenotypes of i through the inverted index."""
+        for i, phenotype_set in enumerate(sets):
+            shared = {}
+            for phenotype in phenotype_set:
+                for j in index[phenotype]:
+                    if j > i:
+                        shared[j] = shared.get(j, 0) + 1
+            for j in sorted(shared):
+                score = shared[j] / (len(phenotype_set) + len(sets[j]) - shared[j])
+                if min_jaccard is None or score >= min_jaccard:
+                    yield (i, j, score)
+    if top_k is None:
+        for i, j, score in scored_pairs():
+            yield (disease_ids[i], disease_ids[j], score)
+        return
+    for i, j, score in scored_pairs():
+        for a, b in ((i, j), (j, i)):
+            if len(heaps[a]) < top_k:
+                heapq.heappush(heaps[a], (score, -b))
+            elif (score, -b) > heaps[a][0]:
+                heapq.heapreplace(heaps[a], (score, -b))
+    # a pair is kept if it is among the best pairs of either disease
+    kept = {}
+    for a, heap in enumerate(heaps):
+        for score, b in heap:
+            kept[(min(a, -b), max(a, -b))] = score
+    for i, j in sorted(kept):
+        yield (disease_ids[i], disease_ids[j], kept[(i, j)])
+
+def read_journal (journal_file):
+    """ Read the finished units of an interrupted run from a checkpoint journal. Returns a dictionary of disease -> phenotype set and a dictionary of disease pair -> Jaccard score"""
+    phenotypes = {}
+    scores = {}
+    try:
+        fhand = open(journal_file)
+    except FileNotFoundError:
+        return(phenotypes, scores)
+    with fhand:
+        for line in fhand:
+            try:
+                entry = json.loads(line)
+            except ValueError: # the last line of an interrupted run may be incomplete
+                continue
+            if 'disease' in entry:
+                phenotypes[entry['disease']] = set(entry['phenotypes'])
+            else:
+                scores[tuple(entry['pair'])] = entry['jaccard']
+    return(phenotypes, scores)
+
+def write_journal (entry):
+    """ Append a finished unit to the checkpoint journal"""
+    if journal is not None:
+        journal.write(json.dumps(entry) + '\n')
+        journal.flush()
+
+def compute_results ():
+    """ Yield [disease_1, disease_2, jaccard] rows as they are computed"""
+    if args.annotations or args.local:
+        if args.annotations:
+            phenotypes = read_annotations(args.annotations)
+        else:
+            phenotypes = dict(journalled_phenotypes)
+            unique_ids = [d for d in dict.fromkeys(disease_ids) if d not in phenotypes]
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                futures = {pool.submit(get_phenotypes, disease): disease for disease in unique_ids}
+                for future in as_completed(futures):
+                    disease = futures[future]
+                    phenotypes[disease] = future.result()
+                    write_journal({'disease': disease, 'phenotypes': sorted(phenotypes[disease])})
+        if args.top_k is not None or args.min_jaccard is not None:
+            scores = pruned_jaccard(phenotypes, args.min_jaccard, args.top_k)
+        else:
+            scores = local_jaccard(phenotypes)
+        for disease1, disease2, similarity in scores:
+            yield [disease1, disease2, str(similarity)]
+    else:
+        for i in disease_pairs:
+            if i in journalled_scores:
+                similarity = journalled_scores[i]
+            else:
+                similarity = jaccard(i[0], i[1]).strip()
+                write_journal({'pair': i, 'jaccard': similarity})
+            yield [i[0], i[1], similarity]
+
+def score_key (record):
+    """ Sort key for descending numeric Jaccard scores (anything that is not a number goes last)"""
+    try:
+        return(-float(record[2]))
+    except ValueError:
+        return(float('inf'))
+
+def external_sort (records, tmpdir):
+    """ Sort records by descending Jaccard score with bounded memory: sort chunks in memory, spill them to disk as sorted runs, then merge the runs.
+    The sort is stable, like list.sort()."""
+    runs = []
+    while True:
+        chunk = list(islice(records, args.chunk_size))
+        if not chunk:
+            break
+        chunk.sort(key = score_key)
+        if not runs and len(chunk) < args.chunk_size: # everything fits in memory
+            yield from chunk
+            return
+        run_file = os.path.join(tmpdir, f'run{len(runs)}.tsv')
+        with open(run_file, 'w', newline='') as run:
+            csv.writer(run, delimiter='\t', lineterminator='\n').writerows(chunk)
+        runs.append(run_file)
+    run_handles = [open(run_file, newline='') for run_file in runs]
+    try:
+        # heapq.merge keeps equal scores in run order, so the merge is stable too
+        yield from heapq.merge(*(csv.reader(run, delimiter='\t') for run in run_handles), key = score_key)
+    finally:
+        for run in run_handles:
+            run.close()
+
+# checkpoint journal of an interrupted run
+if args.resume:
+    journalled_phenotypes, journalled_scores = read_journal(args.journal)
+else:
+    journalled_phenotypes, journalled_scores = {}, {}
+if args.journal and not args.annotations:
+    journal = open(args.journal, 'a' if args.resume else 'w')
+    if journal.tell() > 0: # make sure an incomplete last line is not continued
+        with open(args.journal, 'rb') as fhand:
+            fhand.seek(-1, os.SEEK_END)
+            if fhand.read(1) != b'\n':
+                journal.write('\n')
 else:
-    print("For the results, check the file:", args.outfile)
-    with open(args.outfile, 'w', newline='') as tsvfile:
-        writer = csv.writer(tsvfile, delimiter='\t', lineterminator='\n')
-        for record in results:
-            writer.writerow( record )
+    journal = None
+
+# compute results
+header = ['disease_1', 'disease_2', 'jaccard']
+with tempfile.TemporaryDirectory() as tmpdir:
+    results = compute_results()
+    # sort results by descending Jaccard score
+    if args.sort_results:
+        results = external_sort(results, tmpdir)
+    #else:
+    #    print("Not sorting.")
+
+    if args.outfile == None:
+        print(*header)
+        for r in results:
+            print(*r) # using the '*' or 'splat' operator
+    else:
+        print("For the results, check the file:", args.outfile)
+        opener = gzip.open if args.outfile.endswith('.gz') else open
+        with opener(args.outfile, 'wt', newline='') as tsvfile:
+            writer = csv.writer(tsvfile, delimiter='\t', lineterminator='\n')
+            writer.writerow( header )
+            # write the results in chunks as they are computed
+            while True:
+                chunk = list(islice(results, args.chunk_size))
+                if not chunk:
+                    break
+                writer.writerows( chunk )
+
+if journal is not None:
+    journal.close()
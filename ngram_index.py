@@ -0,0 +1,162 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Character n-gram index for approximate string matching. Candidate strings are looked up in an inverted index of n-grams and then verified with a bounded Levenshtein distance or the Jaro similarity. Used by the --fuzzy mode of partial_match1.py."""
+
+import heapq
+import math
+from array import array
+from collections import Counter
+
+# padding characters, so that the start and the end of a string make n-grams of their own
+START = '\x02'
+END = '\x03'
+
+def ngrams(s, n):
+    """ Get the set of character n-grams of a padded string."""
+    padded = START * (n - 1) + s + END * (n - 1)
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+def levenshtein(a, b, max_distance):
+    """ Get the edit distance between two strings, or max_distance + 1 if it is larger than max_distance.
+    Only a band of 2 * max_distance + 1 cells of each row is computed and the calculation stops as soon as a whole row exceeds the bound."""
+    if len(a) > len(b):
+        a, b = b, a
+    m, n = len(a), len(b)
+    big = max_distance + 1
+    if n - m > max_distance:
+        return big
+    previous = [i if i <= max_distance else big for i in range(m + 1)]
+    for j in range(1, n + 1):
+        c = b[j - 1]
+        current = [big] * (m + 1)
+        if j <= max_distance:
+            current[0] = j
+        row_min = current[0]
+        for i in range(max(1, j - max_distance), min(m, j + max_distance) + 1):
+            cost = previous[i - 1] + (a[i - 1] != c)
+            if previous[i] + 1 < cost:
+                cost = previous[i] + 1
+            if current[i - 1] + 1 < cost:
+                cost = current[i - 1] + 1
+            current[i] = cost
+            if cost < row_min:
+                row_min = cost
+        if row_min > max_distance:
+            return big
+        previous = current
+    return min(previous[m], big)
+
+def levenshtein_similarity(a, b, max_distance):
+    """ Get 1 - edit distance / length of the longer string (0 if the distance is larger than max_distance)."""
+    length = max(len(a), len(b))
+    if not length:
+        return 1.0
+    distance = levenshtein(a, b, max_distance)
+    if distance > max_distance:
+        return 0.0
+    return 1 - distance / length
+
+def jaro(a, b):
+    """ Get the Jaro similarity of two strings."""
+    if a == b:
+        return 1.0
+    la, lb = len(a), len(b)
+    if not la or not lb:
+        return 0.0
+    window = max(max(la, lb) // 2 - 1, 0)
+    matched_b = [False] * lb
+    matches_a = []
+    for i, c in enumerate(a):
+        for j in range(max(0, i - window), min(lb, i + window + 1)):
+            if not matched_b[j] and b[j] == c:
+                matched_b[j] = True
+                matches_a.append(c)
+                break
+    m = len(matches_a)
+    if not m:
+        return 0.0
+    matches_b = [c for c, matched in zip(b, matched_b) if matched]
+    transpositions = sum(x != y for x, y in zip(matches_a, matches_b)) / 2
+    return (m / la + m / lb + (m - transpositions) / m) / 3
+
+class NgramIndex:
+    """ Inverted index from the character n-grams of a list of strings to the positions of the strings that contain them."""
+
+    def __init__(self, strings, n=3):
+        self.n = n
+        self.strings = list(strings)
+        self.postings = dict() # n-gram -> positions of the strings
+        self.by_length = dict() # length -> positions of the strings
+        self.sizes = array('I') # number of distinct n-grams of each string
+        for i, s in enumerate(self.strings):
+            grams = ngrams(s, n)
+            for gram in grams:
+                self.postings.setdefault(gram, array('I')).append(i)
+            self.sizes.append(len(grams))
+            self.by_length.setdefault(len(s), []).append(i)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def search(self, query, threshold, top_k, metric='levenshtein', max_candidates=1000):
+        """ Get up to top_k (similarity, position) pairs of the indexed strings at least threshold (0 < threshold <= 1) similar to the query, most similar first.
+        With the Levenshtein similarity the n-gram filter is exact: no string above the threshold is missed. The Jaro similarity has no such bound, so only the max_candidates strings sharing the most n-grams with the query are verified."""
+        if metric == 'jaro':
+            scores = self.jaro_candidates(query, threshold, max_candidates)
+        else:
+            scores = self.levenshtein_candidates(query, threshold)
+        return heapq.nlargest(top_k, ((score, i) for i, score in scores if score >= threshold), key=lambda x: (x[0], -x[1]))
+
+    def length_range(self, low, high):
+        """ Yield the positions of the strings with a length from low to high."""
+        for length in range(max(low, 0), high + 1):
+            yield from self.by_length.get(length, ())
+
+    def levenshtein_candidates(self, query, threshold):
+        """ Yield (position, similarity) for the strings that pass the length and n-gram count filters."""
+        n = self.n
+        m = len(query)
+        grams = ngrams(query, n)
+        # any string at least threshold similar is within this edit distance of the query
+        max_distance = math.floor((1 - threshold) * m / threshold + 1e-9)
+        low, high = math.ceil(threshold * m - 1e-9), math.floor(m / threshold + 1e-9)
+        # each edit destroys at most n of the query's n-grams
+        shared = len(grams) - n * max_distance
+        if shared < 1:
+            # the n-grams cannot rule out anything, only the lengths can
+            for i in self.length_range(low, high):
+                s = self.strings[i]
+                bound = math.floor((1 - threshold) * max(m, len(s)) + 1e-9)
+                yield (i, levenshtein_similarity(query, s, bound))
+            return
+        # count the n-grams each string shares with the query (the positions in the postings are distinct)
+        counts = Counter()
+        for gram in grams:
+            counts.update(self.postings.get(gram, ()))
+        for i, count in counts.items():
+            if count < shared:
+                continue
+            s = self.strings[i]
+            length = len(s)
+            if length < low or length > high:
+                continue
+            bound = math.floor((1 - threshold) * max(m, length) + 1e-9)
+            if abs(m - length) > bound:
+                continue
+            # each edit destroys at most n of the n-grams of either string
+            if count < max(len(grams), self.sizes[i]) - n * bound:
+                continue
+            yield (i, levenshtein_similarity(query, s, bound))
+
+    def jaro_candidates(self, query, threshold, max_candidates):
+        """ Yield (position, similarity) for the strings sharing the most n-grams with the query."""
+        m = len(query)
+        counts = Counter()
+        for gram in ngrams(query, self.n):
+            counts.update(self.postings.get(gram, ()))
+        for i, _ in counts.most_common(max_candidates):
+            s = self.strings[i]
+            # the Jaro similarity is at most (2 + shorter / longer length) / 3
+            if m and s and (2 + min(m, len(s)) / max(m, len(s))) / 3 < threshold:
+                continue
+            yield (i, jaro(query, s))
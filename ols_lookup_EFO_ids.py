@@ -8,28 +8,58 @@ __version__ = "0.1"
 ######################################################################
 ######################################################################
 import requests # to make API requests
+import sys # to print messages to standard error
 import argparse # to take CLI user input
+from concurrent.futures import ThreadPoolExecutor # to look up terms concurrently
+from urllib3.util.retry import Retry # to retry failed API requests
+import sqlite3 # for the local term cache
+import json # to read OBO Graphs JSON ontology dumps
+import gzip # to read compressed ontology dumps
+import re # to parse OBO ontology dumps
+import xml.etree.ElementTree as ET # to read OWL (RDF/XML) ontology dumps
 
-# function definition from https://hackersandslackers.com/extract-data-from-complex-json-python/
-def json_extract(obj, key):
-    """Recursively fetch values from nested JSON."""
-    arr = []
+import timeit # to benchmark the JSON field extraction
+
+def json_extract(obj, keys):
+    """Fetch the values of several keys from nested JSON in a single walk. Return a dictionary of key -> list of values in document order."""
+    found = {key: [] for key in keys}
+    stack = [(None, obj)] # explicit stack of (key, value) pairs instead of recursion
+    while stack:
+        key, item = stack.pop()
+        if key in found:
+            found[key].append(item)
+        if isinstance(item, dict):
+            stack.extend(reversed(item.items())) # visit the children in document order
+        elif isinstance(item, list):
+            stack.extend((None, v) for v in reversed(item))
+    return found
 
-    def extract(obj, arr, key):
-        """Recursively search for values of key in JSON tree."""
-        if isinstance(obj, dict):
-            for k, v in obj.items():
-                if isinstance(v, (dict, list)):
-                    extract(v, arr, key)
-                elif k == key:
-                    arr.append(v)
-        elif isinstance(obj, list):
-            for item in obj:
-                extract(item, arr, key)
-        return arr
-
-    values = extract(obj, arr, key)
-    return values
+def first_value(value):
+    """Get the first element of a list (or the value itself if it is not a list)."""
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+def term_fields(response):
+    """Get the label, description, synonyms and obsolete flag of the term in an OLS response. Return None if there is no term."""
+    try:
+        term = response['_embedded']['terms'][0]
+        label = term['label']
+    except (KeyError, IndexError, TypeError):
+        # unexpected response layout: search the whole tree once
+        found = json_extract(response, ('label', 'description', 'synonyms', 'is_obsolete'))
+        labels = [v for v in found['label'] if isinstance(v, str)]
+        if not labels:
+            return None
+        term = {'label': labels[0],
+                'description': first_value(found['description']),
+                'synonyms': first_value(found['synonyms']),
+                'is_obsolete': first_value(found['is_obsolete'])}
+        label = term['label']
+    return {'label': first_value(label),
+            'description': first_value(term.get('description')),
+            'synonyms': term.get('synonyms') or [],
+            'obsolete': bool(term.get('is_obsolete'))}
 
 ######################################################################
 ### Read in file with a list of CURIEs.
@@ -39,16 +69,32 @@ fname = 'filename?'
 parser = argparse.ArgumentParser( description='Proved a list of compact uniform resource identifiers (CURIEs, e.g. EFO:0005273) in a text file in a format of one CURIE per line.', formatter_class=argparse.RawTextHelpFormatter )
 
 ### Mandatory positional argument
-parser.add_argument( 'input_file', help='Path to your input file.' )
+parser.add_argument( 'input_file', help='Path to your input file. It can be left out when only prefetching terms into the cache.', nargs='?', default=None )
 
 ### Optional, but mutually exclusive user option:
 group = parser.add_mutually_exclusive_group()
 group.add_argument('-d', '--definition', help='Look up term definition.', action='store_true')
 
+### Optional arguments:
+parser.add_argument('-w', '--workers', help='Number of concurrent requests to the OLS API (default: 4).', type=int, default=4)
+parser.add_argument('--cache', help='Path to a local SQLite term cache (created if missing). Cached terms are used first and\nrefetched when the version of their ontology changes.', default=None)
+parser.add_argument('--prefetch', help='Load all terms from local ontology dumps (OBO, OWL RDF/XML or OBO Graphs JSON, optionally gzipped)\ninto the cache. Only terms defined by the ontology of each dump are stored.', nargs='+', default=[])
+parser.add_argument('--offline', help='Use the cache only and never contact OLS. Terms missing from the cache are reported as N/A.', action='store_true')
+parser.add_argument('--benchmark', help='Time the field extraction on recorded OLS JSON responses (paths to the files) and exit.', nargs='+', default=None)
+parser.add_argument('--ols_url', help='OLS API endpoint to use (default: the EMBL-EBI OLS 4 findByIdAndIsDefiningOntology endpoint).\nPoint it at a local mock server for testing.', default=None)
+parser.add_argument('--ols_ontology_url', help='OLS API ontologies endpoint to get ontology versions from (default: https://www.ebi.ac.uk/ols4/api/ontologies/).', default=None)
+
 args = parser.parse_args()
 # input filename
 fname = args.input_file
 
+if args.workers < 1:
+    parser.error('--workers must be at least 1')
+if ( args.prefetch or args.offline ) and not args.cache:
+    parser.error('--prefetch and --offline require --cache')
+if fname is None and not ( args.prefetch or args.benchmark ):
+    parser.error('the input_file is required unless you --prefetch terms')
+
 # Use the OLS 4 endpoint to retrieve terms only from defining ontology 
 ## see OLS 3 documentation at https://www.ebi.ac.uk/ols/docs/api 
 ### for example
@@ -58,6 +104,302 @@ fname = args.input_file
 
 # API endpoint to use
 BASE_OLS_URL = f'https://www.ebi.ac.uk/ols4/api/terms/findByIdAndIsDefiningOntology?iri='
+if args.ols_url:
+    BASE_OLS_URL = args.ols_url
+# API endpoint to get the current version of an ontology (e.g. .../ontologies/efo)
+BASE_OLS_ONTOLOGY_URL = 'https://www.ebi.ac.uk/ols4/api/ontologies/'
+if args.ols_ontology_url:
+    BASE_OLS_ONTOLOGY_URL = args.ols_ontology_url
+
+# Share a pool of keep-alive connections between the worker threads and
+## retry rate-limited (429) or failed (5xx) requests with exponential back-off.
+retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], respect_retry_after_header=True)
+adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.workers, max_retries=retries)
+session = requests.Session()
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+def ontology_id(curie):
+    """Get the (lower case) ontology identifier from the prefix of a CURIE."""
+    return(curie.split(':')[0].lower())
+
+def fetch_term(curie):
+    """Look up a CURIE in OLS. Return a dictionary with the label, description, synonyms and obsolete flag of the term or None if it is not found
+    or the lookup fails (e.g. still rate-limited after all the retries), so that one failure does not stop the other lookups."""
+    columns = curie.split(':')
+    prefix = columns[0]
+    # You need to convert the compact uniform resource identifiers (CURIEs) to EBI PURLs (e.g. EFO:0005273 --> http://www.ebi.ac.uk/efo/EFO_0005273, 
+    # or OBO Library PURLs, e.g. OBA:VT0002460 --> http://purl.obolibrary.org/obo/OBA_VT0002460
+    if prefix.lower() == 'efo':
+        IRI_BASE = 'http://www.ebi.ac.uk/efo/'
+    else:
+        IRI_BASE = 'http://purl.obolibrary.org/obo/'
+    purl = BASE_OLS_URL + IRI_BASE + curie.replace(':', '_')
+    #print(purl) # for debugging
+    try:
+        response = session.get(purl, timeout=60).json()
+    except (requests.exceptions.RequestException, ValueError) as error:
+        print(f'WARNING: lookup of {curie} failed: {error}', file=sys.stderr)
+        return(None)
+    return(term_fields(response))
+
+def format_term(curie, term):
+    """Format the output line for a term."""
+    if term is None:
+        return(f"{curie}\tN/A\t")
+    if args.definition:
+        description = term['description'] or 'N/A'
+    else:
+        description = ''
+    return(f"{curie}\t{term['label']}\t{description}")
+
+#################################################################
+# Local term cache
+#################################################################
+def open_cache(cache_file):
+    """Open (or create) the SQLite term cache."""
+    db = sqlite3.connect(cache_file)
+    db.execute('CREATE TABLE IF NOT EXISTS terms (curie TEXT PRIMARY KEY, ontology TEXT, version TEXT, label TEXT, description TEXT)')
+    db.execute('CREATE TABLE IF NOT EXISTS ontologies (ontology TEXT PRIMARY KEY, version TEXT)')
+    return(db)
+
+def normalise_version(version):
+    """Reduce an ontology version or version IRI (e.g. http://purl.obolibrary.org/obo/mondo/releases/2024-01-03/mondo.owl) to a comparable release string."""
+    if version is None:
+        return(None)
+    version = version.strip()
+    match = re.search(r'releases/([^/]+)', version)
+    if match:
+        version = match.group(1)
+    return(version.lstrip('vV'))
+
+def current_version(ontology):
+    """Get the current version of an ontology from OLS, or None (accept any cached version) when working offline."""
+    if args.offline:
+        return(None) # accept any cached version
+    try:
+        response = session.get(BASE_OLS_ONTOLOGY_URL + ontology, timeout=60)
+        if not response.ok:
+            return(None)
+        config = response.json().get('config', {})
+    except (requests.exceptions.RequestException, ValueError) as error:
+        print(f'WARNING: version lookup of {ontology} failed: {error}', file=sys.stderr)
+        return(None)
+    version = normalise_version(config.get('version') or config.get('versionIri'))
+    with cache:
+        cache.execute('INSERT OR REPLACE INTO ontologies VALUES (?, ?)', (ontology, version))
+    return(version)
+
+def cached_term(curie, versions):
+    """Get a term from the cache if it is there and up to date, otherwise return None."""
+    ontology = ontology_id(curie)
+    if ontology not in versions:
+        versions[ontology] = current_version(ontology)
+    row = cache.execute('SELECT version, label, description FROM terms WHERE curie = ?', (curie,)).fetchone()
+    if row is None:
+        return(None)
+    if versions[ontology] is not None and row[0] != versions[ontology]:
+        return(None) # stale
+    return({'label': row[1], 'description': row[2]})
+
+def store_terms(terms, versions):
+    """Save a dictionary of CURIE -> term in the cache."""
+    with cache: # a single transaction
+        cache.executemany('INSERT OR REPLACE INTO terms VALUES (?, ?, ?, ?, ?)',
+            ((curie, ontology_id(curie), versions.get(ontology_id(curie)), t['label'], t['description']) for curie, t in terms.items()))
+
+#################################################################
+# Ontology dump readers
+## each yields the ontology version first, then (CURIE, label, description) tuples
+#################################################################
+def iri_to_curie(iri):
+    """Convert a PURL to a CURIE, e.g. http://purl.obolibrary.org/obo/MONDO_0000001 --> MONDO:0000001"""
+    return(iri.rstrip('/').rsplit('/', 1)[-1].rsplit('#', 1)[-1].replace('_', ':', 1))
+
+def ontology_name(iri):
+    """Get the ontology identifier from an ontology IRI or name, e.g. http://www.ebi.ac.uk/efo/efo.owl --> efo"""
+    name = iri.strip().rstrip('/').rsplit('/', 1)[-1]
+    for extension in ('.owl', '.obo', '.json'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return(name.lower() or None)
+
+def read_obo(fhand):
+    """Read terms from an OBO format ontology dump. The first item is the (version, ontology) of the dump header."""
+    version = None
+    ontology = None
+    term = None
+    for line in fhand:
+        line = line.rstrip('\n')
+        if term is None and line.startswith('data-version:'):
+            version = line.split(':', 1)[1].strip()
+        elif term is None and line.startswith('ontology:'):
+            ontology = ontology_name(line.split(':', 1)[1])
+        elif line.startswith('['):
+            if term is None:
+                yield (version, ontology)
+            elif 'id' in term:
+                yield (term['id'], term.get('name'), term.get('def'))
+            term = {} if line == '[Term]' else {'skip': True}
+        elif term is not None and 'skip' not in term and ': ' in line:
+            tag, value = line.split(': ', 1)
+            if tag == 'id':
+                term['id'] = value.strip()
+            elif tag == 'name':
+                term['name'] = value.strip()
+            elif tag == 'def':
+                match = re.match(r'"((?:[^"\\]|\\.)*)"', value)
+                term['def'] = match.group(1).replace('\\"', '"') if match else value
+    if term is None:
+        yield (version, ontology)
+    elif 'id' in term:
+        yield (term['id'], term.get('name'), term.get('def'))
+
+def read_obographs(fhand):
+    """Read terms from an OBO Graphs JSON ontology dump. The first item is the (version, ontology) of the first graph."""
+    data = json.load(fhand)
+    graphs = data.get('graphs', [])
+    if graphs:
+        yield (graphs[0].get('meta', {}).get('version'), ontology_name(graphs[0]['id']) if graphs[0].get('id') else None)
+    else:
+        yield (None, None)
+    for graph in graphs:
+        for node in graph.get('nodes', []):
+            if node.get('type', 'CLASS') != 'CLASS' or 'id' not in node:
+                continue
+            definition = node.get('meta', {}).get('definition', {}).get('val')
+            yield (iri_to_curie(node['id']), node.get('lbl'), definition)
+
+def read_owl(fhand):
+    """Read terms from an OWL (RDF/XML) ontology dump, one class at a time. The first item is the (version, ontology) of the owl:Ontology header."""
+    OWL = '{http://www.w3.org/2002/07/owl#}'
+    RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+    RDFS = '{http://www.w3.org/2000/01/rdf-schema#}'
+    DEFINITION = '{http://purl.obolibrary.org/obo/}IAO_0000115'
+    version = None
+    ontology = None
+    version_sent = False
+    root = None
+    depth = 0
+    for event, elem in ET.iterparse(fhand, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if elem.tag == OWL + 'Ontology':
+            if elem.get(RDF + 'about'):
+                ontology = ontology_name(elem.get(RDF + 'about'))
+            version_iri = elem.find(OWL + 'versionIRI')
+            version_info = elem.find(OWL + 'versionInfo')
+            if version_iri is not None:
+                version = version_iri.get(RDF + 'resource')
+            elif version_info is not None:
+                version = version_info.text
+        elif elem.tag == OWL + 'Class' and depth == 1:
+            if not version_sent:
+                yield (version, ontology)
+                version_sent = True
+            about = elem.get(RDF + 'about')
+            if about:
+                yield (iri_to_curie(about), elem.findtext(RDFS + 'label'), elem.findtext(DEFINITION))
+        if depth == 1:
+            root.remove(elem) # keep memory use flat
+    if not version_sent:
+        yield (version, ontology)
+
+def prefetch(dump_file):
+    """Load all the terms defined by the ontology of a dump file into the cache."""
+    opener = gzip.open if dump_file.endswith('.gz') else open
+    name = dump_file[:-3] if dump_file.endswith('.gz') else dump_file
+    if name.endswith('.json'):
+        reader, mode = read_obographs, 'rt'
+    elif name.endswith('.obo'):
+        reader, mode = read_obo, 'rt'
+    else:
+        reader, mode = read_owl, 'rb' # let the XML parser handle the encoding
+    with opener(dump_file, mode) as fhand:
+        terms = reader(fhand)
+        version, ontology = next(terms)
+        version = normalise_version(version)
+        counts = {}
+        def defined_terms():
+            """Skip imported terms: they belong to the version of their own ontology."""
+            for curie, label, description in terms:
+                if label is None:
+                    continue
+                counts[ontology_id(curie)] = counts.get(ontology_id(curie), 0) + 1
+                yield (curie, ontology_id(curie), version, label, description)
+        with cache: # a single transaction
+            cache.execute('CREATE TEMP TABLE IF NOT EXISTS dump (curie TEXT PRIMARY KEY, ontology TEXT, version TEXT, label TEXT, description TEXT)')
+            cache.execute('DELETE FROM dump')
+            cache.executemany('INSERT OR REPLACE INTO dump VALUES (?, ?, ?, ?, ?)', defined_terms())
+            # the defining ontology is named in the dump header (dumps can import many terms of other ontologies),
+            # e.g. go for go-basic.owl; without a header it is the one contributing the most terms
+            if ontology is not None and ontology not in counts and ontology.split('-')[0] in counts:
+                ontology = ontology.split('-')[0]
+            if ontology is None:
+                ontology = max(counts, key=counts.get) if counts else None
+            cache.execute('DELETE FROM terms WHERE ontology = ?', (ontology,))
+            cache.execute('INSERT OR REPLACE INTO terms SELECT * FROM dump WHERE ontology = ?', (ontology,))
+            cache.execute('INSERT OR REPLACE INTO ontologies VALUES (?, ?)', (ontology, version))
+            cache.execute('DELETE FROM dump')
+    print(f'Prefetched {counts.get(ontology, 0)} {ontology} terms (version {version}) from {dump_file}', file=sys.stderr)
+
+#################################################################
+# Benchmark the JSON field extraction
+#################################################################
+def recursive_extract(obj, key):
+    """The previous recursive extractor, kept for comparison."""
+    arr = []
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if isinstance(v, (dict, list)):
+                arr.extend(recursive_extract(v, key))
+            elif k == key:
+                arr.append(v)
+    elif isinstance(obj, list):
+        for item in obj:
+            arr.extend(recursive_extract(item, key))
+    return arr
+
+def benchmark(payload_files, repeat=1000):
+    """Compare the extraction cost per term of the previous recursive extractor with the direct-path and the single-walk extractors."""
+    payloads = []
+    for payload_file in payload_files:
+        with open(payload_file, encoding='utf-8') as fhand:
+            payloads.append(json.load(fhand))
+    def previous():
+        for response in payloads:
+            if recursive_extract(response, 'label'):
+                recursive_extract(response, 'label')[0]
+                description = response['_embedded']['terms'][0]['description']
+                if description: # terms without a definition have an empty list
+                    description[0]
+    timings = {
+    'recursive json_extract (twice per term)': previous,
+    'direct path': lambda: [term_fields(response) for response in payloads],
+    'single walk with explicit stack': lambda: [json_extract(response, ('label', 'description', 'synonyms', 'is_obsolete')) for response in payloads],
+    }
+    for name, f in timings.items():
+        seconds = min(timeit.repeat(f, number=repeat, repeat=5)) / repeat / len(payloads)
+        print(f'{name}:\t{seconds * 1e6:.1f} microseconds per term')
+
+if args.benchmark:
+    benchmark(args.benchmark)
+    sys.exit()
+
+#################################################################
+# Prefetch terms into the cache
+#################################################################
+if args.cache:
+    cache = open_cache(args.cache)
+for dump_file in args.prefetch:
+    prefetch(dump_file)
+if fname is None:
+    cache.close()
+    sys.exit()
 
 #################################################################
 # print header line
@@ -76,35 +418,34 @@ except:
     exit()
 
 # read in data
+curies = []
 for line in fhand1:
     if line.startswith('#'): # skip header line
         continue
     line = line.rstrip() # strip whitespace
-    curie = line
-    columns = line.split(':')
-    prefix = columns[0]
-    # You need to convert the compact uniform resource identifiers (CURIEs) to EBI PURLs (e.g. EFO:0005273 --> http://www.ebi.ac.uk/efo/EFO_0005273, 
-    # or OBO Library PURLs, e.g. OBA:VT0002460 --> http://purl.obolibrary.org/obo/OBA_VT0002460
-    if prefix.lower() == 'efo':
-        IRI_BASE = 'http://www.ebi.ac.uk/efo/'
-    else:
-        IRI_BASE = 'http://purl.obolibrary.org/obo/'
-    purl = BASE_OLS_URL + IRI_BASE + curie.replace(':', '_')
-    #print(purl) # for debugging
-    response = requests.get(purl).json()
-    if json_extract(response, 'label'):
-        label = json_extract(response, 'label')
-        if args.definition:
-            if response['_embedded']['terms'][0]['description'][0]:
-                description = response['_embedded']['terms'][0]['description'][0]
-            else:
-                description = 'N/A'
-        else:
-            description = ''
-        print(f"{curie}\t{label[0]}\t{description}")
-    else:
-        label = 'N/A'
-        print(f"{curie}\t{label[0]}\t")
+    curies.append(line)
 
 # close file
 fhand1.close()
+
+# check the cache first
+terms = {}
+versions = {}
+if args.cache:
+    for curie in curies:
+        if curie not in terms:
+            terms[curie] = cached_term(curie, versions)
+missing = list(dict.fromkeys(c for c in curies if terms.get(c) is None))
+
+# look up the remaining terms concurrently and print the results in input order
+if missing and not args.offline:
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        fetched = dict(zip(missing, pool.map(fetch_term, missing)))
+    terms.update(fetched)
+    if args.cache:
+        store_terms({c: t for c, t in fetched.items() if t is not None}, versions)
+if args.cache:
+    cache.close()
+
+for curie in curies:
+    print(format_term(curie, terms.get(curie)))
@@ -11,6 +11,13 @@ __version__ = "1.0"
 #########################################################################
 import argparse
 import sys
+# Standard library modules for the --workers mode
+import multiprocessing
+import time
+# Multi-pattern search to find all the list1 elements in a list2 element at once (see aho_corasick.py)
+from aho_corasick import AhoCorasick
+# Approximate matching with a character n-gram index (see ngram_index.py)
+from ngram_index import NgramIndex
 
 ### Mandatory positional arguments
 parser = argparse.ArgumentParser( description='1. Take two sets of elements as lists. 2. Go through the elements in the first list and check if they partially match any elements in the second list. 3. Print the results to standard output.' )
@@ -21,10 +28,34 @@ parser.add_argument( 'your_list2', help='Path to your second list file. FORMAT:
 group = parser.add_mutually_exclusive_group()
 group.add_argument('-1', '--matching', help='Print the matching pairs only.', action='store_true')
 group.add_argument('-2', '--no_match', help='Print the non-matching pairs only.', action='store_true')
+group.add_argument('-f', '--fuzzy', help='Print the approximately matching pairs only: for each element in the second list, the most similar whole elements of the first list (e.g. typos, hyphenation, plural forms), as (element1, element2, similarity).', action='store_true')
+
+### Optional arguments:
+parser.add_argument('-c', '--counts', help='Instead of the non-matching pairs, print the number of matches of each list2 element (count<TAB>element), followed by the list2 elements that have no match at all.', action='store_true')
+parser.add_argument('-s', '--similarity', help='Minimum similarity (0 < s <= 1) of the --fuzzy matches (default: 0.8).', type=float, default=0.8)
+parser.add_argument('-k', '--top_k', help='Maximum number of --fuzzy matches per element of the second list (default: 5).', type=int, default=5)
+parser.add_argument('-m', '--metric', help='Similarity of the --fuzzy matches: 1 - Levenshtein distance / length of the longer string (default), or the Jaro similarity.', choices=['levenshtein', 'jaro'], default='levenshtein')
+parser.add_argument('-w', '--workers', help='Number of worker processes matching chunks of the second list in parallel (default: 1). Progress is reported to standard error.', type=int, default=1)
+parser.add_argument('--chunk_size', help='Number of elements of the second list per chunk with --workers (default: 1000).', type=int, default=1000)
+parser.add_argument('-n', '--ngram', help='Length of the character n-grams that the --fuzzy candidates are looked up by (default: 3).', type=int, default=3)
 
 ######################################################################
 # parse input data files
 args = parser.parse_args()
+if args.counts and args.matching:
+    parser.error('--counts replaces the non-matching pairs, it cannot be used with --matching')
+if args.counts and args.fuzzy:
+    parser.error('--counts cannot be used with --fuzzy')
+if not 0 < args.similarity <= 1:
+    parser.error('--similarity must be more than 0 and at most 1')
+if args.top_k < 1:
+    parser.error('--top_k must be at least 1')
+if args.ngram < 1:
+    parser.error('--ngram must be at least 1')
+if args.workers < 1:
+    parser.error('--workers must be at least 1')
+if args.chunk_size < 1:
+    parser.error('--chunk_size must be at least 1')
 
 # data input filenames
 
@@ -81,40 +112,144 @@ for line in fhand:
 fhand.close()
 
 
-# initialise two empty lists to store the results
-matching = []
-no_match = []
+#########################################################################
+# Match list2 chunk by chunk. With --workers the chunks are matched in
+# forked worker processes that share the matcher built from list1, and
+# the results are written in list2 order.
+#########################################################################
+def map_list2(function, chunk_size=None):
+    """ Apply a function to (start, end) chunks of list2 and yield the results in list2 order."""
+    chunk_size = chunk_size or args.chunk_size
+    chunks = [(start, min(start + chunk_size, len(list2))) for start in range(0, len(list2), chunk_size)]
+    if args.workers == 1:
+        yield from map(function, chunks)
+        return
+    sys.stdout.flush() # do not let the worker processes inherit buffered output
+    started = reported = time.time()
+    done = 0
+    with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+        for (start, end), result in zip(chunks, pool.imap(function, chunks)):
+            yield result
+            done += end - start
+            now = time.time()
+            if now - reported >= 5 or done == len(list2):
+                reported = now
+                print(f'{done}/{len(list2)} elements of list2 matched ({done / max(now - started, 1e-9):.0f} per second)', file=sys.stderr)
+
+def write_chunks(title, function, chunk_size=None):
+    """ Print a section of results produced chunk by chunk."""
+    print(title)
+    for text in map_list2(function, chunk_size):
+        sys.stdout.write(text)
+
+# positions of each distinct element in list1 (an element may be listed more than once)
+positions = dict()
+for i, e1 in enumerate(list1):
+    positions.setdefault(e1, []).append(i)
 
-for e2 in list2:
-    for e1 in list1:
-        if e1 in e2:
-            matching.append((e1, e2))
-        else:
-            no_match.append((e1, e2))
+#########################################################################
+# Approximate matching: look up candidates in an n-gram index of list1
+# and keep the top k most similar ones above the threshold
+#########################################################################
+if args.fuzzy:
+    index = NgramIndex(positions, args.ngram)
+
+    def fuzzy_pairs(elements):
+        """ Yield the approximately matching (e1, e2, similarity) triples, most similar first for each e2."""
+        for e2 in elements:
+            for score, i in index.search(e2, args.similarity, args.top_k, args.metric):
+                e1 = index.strings[i]
+                for _ in positions[e1]:
+                    yield (e1, e2, round(score, 3))
+
+    def fuzzy_chunk(chunk):
+        start, end = chunk
+        return ''.join(f'{triple}\n' for triple in fuzzy_pairs(list2[start:end]))
+
+    write_chunks("#### fuzzy matching:", fuzzy_chunk)
+    sys.exit() # stop here
 
+#########################################################################
+# Build one automaton from list1 and scan each list2 element with it once
+#########################################################################
+automaton = AhoCorasick(list1)
+
+# an empty line is part of any string
+empty = positions.get('', [])
+
+def matching_positions(e2):
+    """ Get the positions of the list1 elements that are substrings of e2, in list1 order."""
+    found = list(empty)
+    for e1 in automaton.found(e2):
+        found.extend(positions[e1])
+    found.sort()
+    return found
+
+#########################################################################
+# Generate the results lazily, so that memory use does not grow with
+# the number of pairs (the non-matching pairs are nearly all of them)
+#########################################################################
+def matching_pairs(elements):
+    """ Yield the partially matching (e1, e2) pairs."""
+    for e2 in elements:
+        for i in matching_positions(e2):
+            yield (list1[i], e2)
+
+def non_matching_pairs(elements):
+    """ Yield the non-matching (e1, e2) pairs."""
+    for e2 in elements:
+        found = set(matching_positions(e2))
+        for i, e1 in enumerate(list1):
+            if i not in found:
+                yield (e1, e2)
+
+def matching_chunk(chunk):
+    start, end = chunk
+    return ''.join(f'{pair}\n' for pair in matching_pairs(list2[start:end]))
+
+def non_matching_chunk(chunk):
+    start, end = chunk
+    return ''.join(f'{pair}\n' for pair in non_matching_pairs(list2[start:end]))
+
+def counts_chunk(chunk):
+    """ Get the match counts of a chunk of list2 and its elements without any match."""
+    start, end = chunk
+    counts = []
+    unmatched = []
+    for e2 in list2[start:end]:
+        count = len(matching_positions(e2))
+        counts.append(f'{count}\t{e2}\n')
+        if count == 0:
+            unmatched.append(f'{e2}\n')
+    return (''.join(counts), ''.join(unmatched))
+
+def print_non_matching():
+    """ Print the non-matching pairs, or with --counts the number of matches of each list2 element and the list2 elements without any match."""
+    if args.counts:
+        print("#### match counts:")
+        unmatched = []
+        for counts, no_matches in map_list2(counts_chunk):
+            sys.stdout.write(counts)
+            unmatched.append(no_matches)
+        print("#### no matches:")
+        sys.stdout.writelines(unmatched)
+    else:
+        # a chunk makes len(list1) pairs per element, so keep the chunks small
+        write_chunks("#### non-matching:", non_matching_chunk, max(1, min(args.chunk_size, 1000000 // max(len(list1), 1))))
 
 # print the list of partially matching pairs
 
 if args.matching:
-    print("#### matching:")
-    for i in matching:
-        print(i)
+    write_chunks("#### matching:", matching_chunk)
     sys.exit() # stop here
 
 # print the list of non-matching pairs
 
-if args.matching:
-    print("#### non-matching:")
-    for i in no_match:
-        print(i)
+if args.no_match:
+    print_non_matching()
     sys.exit() # stop here
 
 # print everything unless told otherwise if you get so far as this point
 
-print("#### matching:")
-for i in matching:
-    print(i)
-
-print("#### non-matching:")
-for i in no_match:
-    print(i)
+write_chunks("#### matching:", matching_chunk)
+print_non_matching()
@@ -10,11 +10,20 @@ __version__ = "2022-05-16."
 # Import command-line parsing module from the Python standard library.
 ######################################################################
 import argparse
+# Compiled, memory-mapped dictionaries (see dictionary_index.py)
+from dictionary_index import DictionaryIndex, is_index, read_dictionary, map_chunks, read_chunk
+# Multi-pattern search for the substring and token modes (see aho_corasick.py)
+from aho_corasick import AhoCorasick
+import sys
 
 ### Mandatory positional arguments
 parser = argparse.ArgumentParser( description='Replace some lines in a text stream from a file. DESCRIPTION: This command line tool reads the lines from a plain text file, strips any surrounding white space and tries to look up the line as a string from a dictionary. It then converts the matching line and prints it (or prints the non-matching line unchanged) to standard output.' )
-parser.add_argument( 'your_dictionary', help='Path to your dictionary file. FORMAT: Use two columns separated by tab (default) or comma (optional).' )
-parser.add_argument( 'your_list', help='Path to your text file with the lines to be replace based on your provided dictionary.' )
+parser.add_argument( 'your_dictionary', help='Path to your dictionary file. FORMAT: Use two columns separated by tab (default) or comma (optional), or an index file compiled with dictionary_index.py.' )
+parser.add_argument( 'your_list', help='Path to your text file with the lines to be replace based on your provided dictionary. Use - to read from standard input.' )
+
+### Optional arguments:
+parser.add_argument('-m', '--mode', help='What to replace: whole lines (default), every substring that is a dictionary key, or only keys that are whole tokens (not part of a longer word). Overlapping keys are replaced leftmost-longest first.', choices=['line', 'substring', 'token'], default='line')
+parser.add_argument('-w', '--workers', help='Number of worker processes replacing lines in chunks of a large file in parallel (default: 1).', type=int, default=1)
 
 ### Optional, but mutually exclusive user options:
 group = parser.add_mutually_exclusive_group()
@@ -22,6 +31,10 @@ group.add_argument('-c', '--csv', help='Use comma as column separator.', action=
 group.add_argument('-t', '--tab', help='Use tab as column separator.', action='store_true')
 
 args = parser.parse_args()
+if args.workers < 1:
+    parser.error('--workers must be at least 1')
+if args.workers > 1 and args.your_list == '-':
+    parser.error('--workers needs a text file, not standard input')
 
 ######################################################################
 # The dictionary to use must be provided by the user.
@@ -36,50 +49,81 @@ else:
 # input filename
 fname = args.your_dictionary
 
-
-try:
-    fhand = open( fname )
-except:
-    print('File cannot be opened:', fname)
-    exit()
-
-# Make an empty dictionary:
-d = dict()
-
-for line in fhand:
-    line = line.rstrip()
-    columns = line.split(delimiter)
+if is_index(fname):
+    # a dictionary compiled with dictionary_index.py
+    d = DictionaryIndex(fname)
+else:
     try:
-        k = columns[0]
-        v = columns[1]
+        fhand = open( fname )
     except:
-        v = 'Check your dictionary file format.'
-        print( 'ERROR:', v)
+        print('File cannot be opened:', fname)
         exit()
-    if k not in d:
-        d[k] = v
-# close file
-fhand.close()
+
+    # Make an empty dictionary:
+    d = dict()
+
+    for k, v in read_dictionary(fhand, delimiter):
+        if k not in d:
+            d[k] = v
+    # close file
+    fhand.close()
+
+if args.mode == 'line':
+    def replace_line(line):
+        """ Replace a whole line if it is a dictionary key."""
+        return d.get(line, line)
+else:
+    # one automaton for all the dictionary keys, so each line is scanned once
+    automaton = AhoCorasick(d.keys())
+    tokens = args.mode == 'token'
+    def replace_line(line):
+        """ Replace the dictionary keys in a line."""
+        return automaton.replace(line, d.get, tokens)
 
 #################################################################
 # Read in and convert data file.
 #################################################################
 
+def replace_stream(fhand, out, batch_size=65536):
+    """ Replace the lines of a text stream and write them in batches.
+    As with splitting the whole text at the new lines, a text that ends with a new line gets an extra empty line at the end."""
+    batch = []
+    tail = ''
+    for line in fhand:
+        if line.endswith('\n'):
+            batch.append(replace_line(line[:-1]) + '\n')
+            if len(batch) >= batch_size:
+                out.write(''.join(batch))
+                batch = []
+        else:
+            tail = line # the last line has no new line character
+    batch.append(replace_line(tail) + '\n')
+    out.write(''.join(batch))
+
+def replace_chunk(chunk):
+    """ Replace the lines of a (start, end, is_last) byte range of the file in a worker process."""
+    start, end, is_last = chunk
+    readline = read_chunk(fname, start, end).split("\n")
+    if not is_last:
+        readline.pop() # the empty string after the last new line of the chunk
+    return ''.join(replace_line(line) + '\n' for line in readline)
+
 fname = args.your_list
 
-try:
-    fhand = open( fname )
-except:
-    print('File cannot be opened:', fname)
-    exit()
-
-with open(fname, "r") as file:
-    readline = file.read().split("\n") # remove any explicit new line characters
-    for line in readline:
-        try:
-            print(d[line])
-        except:
-            print(line)
+if fname == '-':
+    fhand = sys.stdin
+else:
+    try:
+        fhand = open( fname, buffering=1 << 20 )
+    except:
+        print('File cannot be opened:', fname)
+        exit()
+
+if args.workers > 1:
+    for output in map_chunks(replace_chunk, fname, args.workers):
+        sys.stdout.write(output)
+else:
+    replace_stream(fhand, sys.stdout)
 
 # close file
 fhand.close()
@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Small sketches of large sets for approximate comparisons: a HyperLogLog sketch estimates the number of distinct elements and a bottom-k MinHash sketch estimates the Jaccard similarity of two sets. A sketch takes a few KB, whatever the size of the set, and can be saved to disk and compared later. Used by the --sketch mode of get_diff_intersection-1.py."""
+
+import heapq
+import math
+import struct
+import sys
+from array import array
+from hashlib import blake2b
+
+######################################################################
+# Sketch file format
+######################################################################
+# header:    MAGIC (8 bytes), HyperLogLog precision p (1 byte),
+#            MinHash size k and number of MinHash values (unsigned 32-bit
+#            integers), number of elements added (unsigned 64-bit integer)
+# registers: 2**p bytes
+# minhashes: the smallest hash values, unsigned 64-bit integers (little endian) in ascending order
+MAGIC = b'CTDSKT1\x00'
+HEADER = struct.Struct('<8sBIIQ')
+
+# z-score of the two-sided 95% confidence intervals reported as error bounds
+Z95 = 1.96
+
+def element_hash(element):
+    """ Get a 64-bit hash of a string that is the same in every run (unlike hash())."""
+    return int.from_bytes(blake2b(element.encode('utf-8', 'surrogateescape'), digest_size=8).digest(), 'little')
+
+def is_sketch(fname):
+    """ Check if a file is a saved sketch."""
+    try:
+        with open(fname, 'rb') as fhand:
+            return fhand.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+class SetSketch:
+    """ HyperLogLog sketch with 2**precision registers and a bottom-k MinHash sketch of the size smallest hash values of a set of strings."""
+
+    def __init__(self, precision=11, size=512):
+        self.precision = precision
+        self.size = size
+        self.registers = bytearray(1 << precision)
+        self.heap = [] # minus the smallest hash values (a max-heap)
+        self.members = set() # the smallest hash values
+        self.count = 0 # number of elements added, including repeats
+
+    def add(self, element):
+        """ Add a string to the set."""
+        self.add_hash(element_hash(element))
+
+    def add_hash(self, h):
+        self.count += 1
+        # HyperLogLog: the first p bits choose the register, which keeps the
+        # maximum position of the first 1 bit in the remaining 64 - p bits
+        bits = 64 - self.precision
+        rest = h & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        i = h >> bits
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+        # MinHash: keep the size smallest distinct hash values
+        if h in self.members:
+            return
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, -h)
+            self.members.add(h)
+        elif h < -self.heap[0]:
+            self.members.discard(-heapq.heapreplace(self.heap, -h))
+            self.members.add(h)
+
+    def update(self, elements):
+        """ Add strings to the set."""
+        for element in elements:
+            self.add(element)
+
+    def minhashes(self):
+        """ Get the smallest hash values in ascending order."""
+        return sorted(self.members)
+
+    def is_exact(self):
+        """ Check if the set has fewer distinct elements than the MinHash size, i.e. the MinHash sketch holds all of them."""
+        return len(self.members) < self.size
+
+    def check_compatible(self, other):
+        if (self.precision, self.size) != (other.precision, other.size):
+            raise ValueError(f'sketches of different sizes cannot be compared (precision {self.precision} and {other.precision}, MinHash size {self.size} and {other.size})')
+
+    def cardinality(self):
+        """ Get the estimated number of distinct elements and its error bound (95% confidence)."""
+        if self.is_exact():
+            return (len(self.members), 0.0)
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros) # linear counting for small sets
+        return (estimate, Z95 * 1.04 / math.sqrt(m) * estimate)
+
+    def union(self, other):
+        """ Get the sketch of the union of two sets."""
+        self.check_compatible(other)
+        merged = SetSketch(self.precision, self.size)
+        merged.registers = bytearray(map(max, self.registers, other.registers))
+        for h in heapq.nsmallest(self.size, self.members | other.members):
+            merged.heap.append(-h)
+            merged.members.add(h)
+        heapq.heapify(merged.heap)
+        merged.count = self.count + other.count
+        return merged
+
+    def jaccard(self, other):
+        """ Get the estimated Jaccard similarity of two sets and its error bound (95% confidence)."""
+        self.check_compatible(other)
+        smallest = heapq.nsmallest(self.size, self.members | other.members)
+        if not smallest:
+            return (0.0, 0.0)
+        both = self.members & other.members
+        j = sum(h in both for h in smallest) / len(smallest)
+        if self.is_exact() and other.is_exact() and len(self.members | other.members) < self.size:
+            return (j, 0.0)
+        return (j, Z95 * math.sqrt(j * (1 - j) / len(smallest)))
+
+    def save(self, fname):
+        """ Write the sketch to a file."""
+        minhashes = array('Q', self.minhashes())
+        if sys.byteorder == 'big':
+            minhashes.byteswap()
+        with open(fname, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, self.precision, self.size, len(minhashes), self.count))
+            out.write(self.registers)
+            out.write(minhashes.tobytes())
+
+    @classmethod
+    def load(cls, fname):
+        """ Read a sketch from a file."""
+        with open(fname, 'rb') as fhand:
+            magic, precision, size, n, count = HEADER.unpack(fhand.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f'{fname} is not a sketch file')
+            sketch = cls(precision, size)
+            sketch.registers = bytearray(fhand.read(1 << precision))
+            minhashes = array('Q')
+            minhashes.frombytes(fhand.read(8 * n))
+        if sys.byteorder == 'big':
+            minhashes.byteswap()
+        sketch.members = set(minhashes)
+        sketch.heap = [-h for h in minhashes]
+        heapq.heapify(sketch.heap)
+        sketch.count = count
+        return sketch